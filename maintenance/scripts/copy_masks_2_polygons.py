@@ -71,20 +71,29 @@ def image_ids_by_name(dataset):
     return ids_by_name
 
 
+def xy_array_to_points_string(xy, separator=" "):
+    """
+    Convert (N, 2) array of x, y points to a points string.
+
+    e.g. array([[309, 427], [366, 503]]) to "309,427 366,503", or
+    "309,427, 366,503" with separator ", "
+    """
+    template = separator.join(["%s,%s"] * len(xy))
+    return template % tuple(np.asarray(xy).ravel().tolist())
+
+
 def add_polygon(roi, contour, x_offset=0, y_offset=0, z=None, t=None):
     """ points is 2D list of [[x, y], [x, y]...]"""
 
     stride = 4
-    coords = []
     # points in contour are adjacent pixels, which is too verbose
     # take every nth point
-    for count, xy in enumerate(contour):
-        if count % stride == 0:
-            coords.append(xy)
+    coords = np.asarray(contour)[::stride]
     if len(coords) < 2:
         return
-    points = ["%s,%s" % (xy[1] + x_offset, xy[0] + y_offset) for xy in coords]
-    points = ", ".join(points)
+    # contour is (y, x)
+    xy = coords[:, ::-1] + [x_offset, y_offset]
+    points = xy_array_to_points_string(xy, ", ")
 
     polygon = omero.model.PolygonI()
     if z is not None:
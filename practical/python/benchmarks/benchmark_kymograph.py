@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------------
+#   Copyright (C) 2026 University of Dundee. All rights reserved.
+
+
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# ------------------------------------------------------------------------------
+
+"""
+Benchmark Kymograph line extraction without an OMERO server.
+
+get_line_data, lines_kymograph and polyline_kymograph from Kymograph.py are
+run against an in-memory Image of synthetic NumPy planes, and the new
+Images are written to memory. The sweep covers line angle, length and
+width, channel count and timepoint count. For each case it reports
+per-call latency, throughput in output pixels/sec and peak memory.
+get_line_data is also compared with the PIL-rotate sampling it replaced.
+
+Needs omero-py and Pillow installed, but no server.
+
+Usage: python benchmark_kymograph.py [--quick] [--csv results.csv]
+"""
+
+import argparse
+import csv
+from io import BytesIO
+import math
+import os
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "server"))
+import Kymograph  # noqa: E402
+
+
+class SyntheticPixels(object):
+    """PixelsWrapper stand-in, reading tiles from SyntheticImage."""
+
+    def __init__(self, image):
+        """Create pixels of image."""
+        self.image = image
+
+    def getId(self):
+        return self.image.getId()
+
+    def getTile(self, the_z=0, the_c=0, the_t=0, tile=None):
+        self.image.calls["getTile"] += 1
+        return self.image.get_plane(the_z, the_c, the_t, tile)
+
+    def getTiles(self, zct_list):
+        self.image.calls["getTiles"] += 1
+        for the_z, the_c, the_t, tile in zct_list:
+            yield self.image.get_plane(the_z, the_c, the_t, tile)
+
+
+class SyntheticImage(object):
+    """
+    ImageWrapper stand-in with synthetic planes held in memory.
+
+    All planes are made from one random plane, offset by Z, C and T, so
+    big movies don't need memory for every plane.
+    """
+
+    def __init__(self, size_x=4096, size_y=4096, size_z=1, size_c=1,
+                 size_t=10, dtype="uint16", image_id=1):
+        """Create the image."""
+        rng = np.random.RandomState(0)
+        self.plane = rng.randint(0, 4000, (size_y, size_x)).astype(dtype)
+        self.sizes = (size_x, size_y, size_z, size_c, size_t)
+        self.image_id = image_id
+        self.active_channel = 0
+        self.calls = Counter()
+
+    def get_plane(self, the_z, the_c, the_t, tile=None):
+        """Get the region (x, y, w, h) of a plane as a numpy array."""
+        size_x, size_y = self.sizes[:2]
+        x, y, w, h = tile if tile is not None else (0, 0, size_x, size_y)
+        offset = (the_z + the_c + the_t) % 100
+        return self.plane[y:y + h, x:x + w] + self.plane.dtype.type(offset)
+
+    def getId(self):
+        return self.image_id
+
+    def getName(self):
+        return "synthetic"
+
+    def getSizeX(self):
+        return self.sizes[0]
+
+    def getSizeY(self):
+        return self.sizes[1]
+
+    def getSizeZ(self):
+        return self.sizes[2]
+
+    def getSizeC(self):
+        return self.sizes[3]
+
+    def getSizeT(self):
+        return self.sizes[4]
+
+    def getPixelsType(self):
+        return str(self.plane.dtype)
+
+    def getPrimaryPixels(self):
+        return SyntheticPixels(self)
+
+    def set_active_channels(self, channels, windows=None, colors=None):
+        self.active_channel = channels[0] - 1
+
+    def renderJpegRegion(self, the_z, the_t, x, y, w, h):
+        """Render a region of the active channel as 8-bit grey JPEG."""
+        self.calls["renderJpegRegion"] += 1
+        data = self.get_plane(the_z, self.active_channel, the_t,
+                              (x, y, w, h))
+        data = (data.astype(np.float64) * 255 / 4100).astype(np.uint8)
+        output = BytesIO()
+        Image.fromarray(data).convert("RGB").save(output, "JPEG")
+        return output.getvalue()
+
+
+class Value(object):
+    """rtypes stand-in."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+
+class MemoryRawPixelsStore(object):
+    """RawPixelsStore stand-in, writing tiles to memory."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def setPixelsId(self, pixels_id, bypass, ctx=None):
+        self.pixels = self.conn.pixels[pixels_id]
+
+    def setTile(self, buf, z, c, t, x, y, w, h, ctx=None):
+        tile = np.frombuffer(buf, dtype=self.pixels.dtype.newbyteorder(">"))
+        self.pixels[c, y:y + h, x:x + w] = tile.reshape(h, w)
+
+    def close(self):
+        pass
+
+
+class MemoryConn(object):
+    """
+    BlitzGateway stand-in that creates new Images in memory.
+
+    Provides just the services used by Kymograph.KymographWriter.
+    """
+
+    SERVICE_OPTS = None
+
+    def __init__(self):
+        self.pixels = {}
+        self.c = self
+        self.sf = self
+
+    def getQueryService(self):
+        return self
+
+    def findByQuery(self, query, params, ctx=None):
+        # "from PixelsType as p where p.value='uint16'"
+        return query.split("'")[1]
+
+    def getPixelsService(self):
+        return self
+
+    def createImage(self, size_x, size_y, size_z, size_t, channels,
+                    pixels_type, name, description, ctx=None):
+        image_id = len(self.pixels) + 1
+        dtype = Kymograph.PIXELS_DTYPES.get(pixels_type, pixels_type)
+        self.pixels[image_id] = np.zeros((len(channels), size_y, size_x),
+                                         dtype=dtype)
+        return Value(image_id)
+
+    def setChannelGlobalMinMax(self, pixels_id, the_c, min_value, max_value,
+                               ctx=None):
+        pass
+
+    def getObject(self, obj_type, obj_id):
+        return SyntheticImage(1, 1, image_id=obj_id)
+
+    def createRawPixelsStore(self):
+        return MemoryRawPixelsStore(self)
+
+
+def baseline_get_line_data(image, x1, y1, x2, y2, line_w=2, the_z=0, the_c=0,
+                           the_t=0):
+    """
+    Sample a line by rotating its padded bounding box with PIL, then crop.
+
+    The sampling get_line_data used before it interpolated only the points
+    along the line, reading raw data.
+    """
+    size_x = image.getSizeX()
+    size_y = image.getSizeY()
+    line_x = x2 - x1
+    line_y = y2 - y1
+    rads = math.atan2(line_y, line_x)
+
+    extra_h = abs(math.sin(rads) * line_w)
+    bottom = int(max(y1, y2) + extra_h/2)
+    top = int(min(y1, y2) - extra_h/2)
+    extra_w = abs(math.cos(rads) * line_w)
+    left = int(min(x1, x2) - extra_w)
+    right = int(max(x1, x2) + extra_w)
+
+    pad_left, pad_right, pad_top, pad_bottom = 0, 0, 0, 0
+    if left < 0:
+        pad_left = abs(left)
+        left = 0
+    if top < 0:
+        pad_top = abs(top)
+        top = 0
+    if right > size_x:
+        pad_right = right - size_x
+        right = size_x
+    if bottom > size_y:
+        pad_bottom = bottom - size_y
+        bottom = size_y
+    w = max(int(right - left), 1)
+    h = max(int(bottom - top), 1)
+
+    tile = image.getPrimaryPixels().getTile(the_z, the_c, the_t,
+                                            (left, top, w, h))
+    tile = np.pad(tile, ((pad_top, pad_bottom), (pad_left, pad_right)),
+                  'constant')
+    pil = Image.fromarray(tile.astype('float32'))
+    rotated = pil.rotate(math.degrees(rads), expand=True)
+
+    length = int(math.sqrt(math.pow(line_x, 2) + math.pow(line_y, 2)))
+    rot_w, rot_h = rotated.size
+    crop_x = (rot_w - length) // 2
+    crop_y = (rot_h - line_w) // 2
+    cropped = rotated.crop((crop_x, crop_y, crop_x + length,
+                            crop_y + line_w))
+    return np.asarray(cropped).astype(tile.dtype)
+
+
+def measure(function, repeats=1):
+    """
+    Call function repeats times, then once more tracing memory.
+
+    Returns (result, seconds per call, peak memory in bytes).
+    """
+    start = time.perf_counter()
+    for i in range(repeats):
+        function()
+    seconds = (time.perf_counter() - start) / repeats
+    tracemalloc.start()
+    result = function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def get_line_end(x1, y1, angle, length):
+    """Get the end of a line from x1, y1 at angle (degrees) and length."""
+    rads = math.radians(angle)
+    return x1 + length * math.cos(rads), y1 + length * math.sin(rads)
+
+
+def benchmark_line_data(image, angles, lengths, widths, repeats):
+    """Time get_line_data and the PIL-rotate baseline for each line."""
+    results = []
+    center_x = image.getSizeX() / 2.0
+    center_y = image.getSizeY() / 2.0
+    for angle in angles:
+        for length in lengths:
+            for width in widths:
+                # Lines are centred on the image
+                x1, y1 = get_line_end(center_x, center_y, angle + 180,
+                                      length / 2.0)
+                x2, y2 = get_line_end(center_x, center_y, angle,
+                                      length / 2.0)
+                for name, function in (
+                        ("get_line_data", Kymograph.get_line_data),
+                        ("pil_rotate_baseline", baseline_get_line_data)):
+                    data, seconds, peak = measure(
+                        lambda: function(image, x1, y1, x2, y2, width),
+                        repeats)
+                    results.append({
+                        "benchmark": name, "angle": angle,
+                        "length": length, "width": width, "size_c": 1,
+                        "size_t": 1, "seconds": seconds,
+                        "pixels_per_sec": data.size / seconds,
+                        "peak_mb": peak / 1e6})
+    return results
+
+
+def benchmark_kymographs(channel_counts, time_counts, lengths, width,
+                         size_xy):
+    """Time lines_kymograph and polyline_kymograph on synthetic movies."""
+    results = []
+    for size_c in channel_counts:
+        for size_t in time_counts:
+            image = SyntheticImage(size_xy, size_xy, size_c=size_c,
+                                   size_t=size_t)
+            for length in lengths:
+                x1 = (size_xy - length) / 2.0
+                y1 = size_xy / 3.0
+                lines = {0: {'theZ': 0, 'x1': x1, 'y1': y1,
+                             'x2': x1 + length, 'y2': y1 + length / 3.0}}
+                # a zig-zag of 4 segments, about the same length
+                step = length / 4.0
+                points = [(x1 + i * step, y1 + (i % 2) * step / 2)
+                          for i in range(5)]
+                polylines = {0: {'theZ': 0, 'points': points}}
+
+                for name, function, shapes in (
+                        ("lines_kymograph", Kymograph.lines_kymograph,
+                         lines),
+                        ("polyline_kymograph", Kymograph.polyline_kymograph,
+                         polylines)):
+                    conn = MemoryConn()
+                    image.calls.clear()
+                    new_image, seconds, peak = measure(
+                        lambda: function(conn, {}, image, shapes, width,
+                                         None))
+                    output = conn.pixels[new_image.getId()]
+                    results.append({
+                        "benchmark": name, "angle": "", "length": length,
+                        "width": width, "size_c": size_c, "size_t": size_t,
+                        "seconds": seconds,
+                        "pixels_per_sec": output.size / seconds,
+                        "peak_mb": peak / 1e6,
+                        # measure() calls function twice
+                        "reads": sum(image.calls.values()) // 2})
+    return results
+
+
+COLUMNS = ["benchmark", "angle", "length", "width", "size_c", "size_t",
+           "seconds", "pixels_per_sec", "peak_mb", "reads"]
+
+
+def print_results(results):
+    """Print results as a table."""
+    print("%-20s %6s %6s %6s %6s %6s %10s %14s %9s %6s" % tuple(COLUMNS))
+    for row in results:
+        print("%-20s %6s %6s %6s %6s %6s %10.5f %14.0f %9.2f %6s" % tuple(
+            row.get(name, "") for name in COLUMNS))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--quick', action='store_true',
+                        help='Run a smaller sweep')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Number of calls to get_line_data per case')
+    parser.add_argument('--csv', help='Also write results to this CSV file')
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        size_xy = 1024
+        angles = [0, 30, 45]
+        lengths = [100, 500]
+        widths = [1, 8]
+        channel_counts = [1, 2]
+        time_counts = [10]
+    else:
+        size_xy = 4096
+        angles = [0, 15, 30, 45, 60, 90, 135]
+        lengths = [100, 1000, 4000]
+        widths = [1, 4, 16]
+        channel_counts = [1, 3]
+        time_counts = [10, 100]
+
+    image = SyntheticImage(size_xy, size_xy)
+    results = benchmark_line_data(image, angles, lengths, widths,
+                                  args.repeats)
+    results.extend(benchmark_kymographs(channel_counts, time_counts,
+                                        lengths, 4, size_xy))
+    print_results(results)
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------------
+#   Copyright (C) 2026 University of Dundee. All rights reserved.
+
+
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# ------------------------------------------------------------------------------
+
+"""
+Benchmark parsing and formatting of OMERO shape points strings.
+
+Compares the NumPy points codec in Kymograph.py with the per-point Python
+code it replaced, for a single polygon with many points and for many
+polylines parsed together. Needs omero-py installed, but no server.
+
+Usage: python benchmark_points.py --points 1000000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "server"))
+import Kymograph  # noqa: E402
+
+
+def baseline_points_string_to_xy_list(string):
+    """Parse a "points[x,y, x,y]" string with a Python loop, as before."""
+    first_list = string.strip().split("points")[1]
+    xy_list = []
+    for xy in first_list.strip(" []").split(", "):
+        x, y = xy.split(",")
+        xy_list.append((float(x.strip()), float(y.strip())))
+    return xy_list
+
+
+def baseline_xy_to_points_string(xy_list):
+    """Format points one at a time, as before."""
+    return ", ".join(["%s,%s" % (x, y) for x, y in xy_list])
+
+
+def time_call(function, *args):
+    """Call function, returning (result, seconds)."""
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def report(name, baseline_secs, secs, point_count):
+    """Print timings of baseline and new code."""
+    print("%-28s baseline %8.3f s   numpy %8.3f s   %6.1fx   %.1f M points/s"
+          % (name, baseline_secs, secs, baseline_secs / secs,
+             point_count / secs / 1e6))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--points', type=int, default=1000000,
+                        help='Number of points in the large polygon')
+    parser.add_argument('--shapes', type=int, default=10000,
+                        help='Number of polylines to parse together')
+    parser.add_argument('--shape-points', type=int, default=100,
+                        help='Number of points in each polyline')
+    args = parser.parse_args(argv)
+
+    rng = np.random.RandomState(0)
+
+    # One large polygon, e.g. a densely traced outline
+    xy = np.round(rng.uniform(0, 4096, (args.points, 2)), 2)
+    points = "points[%s]" % baseline_xy_to_points_string(xy.tolist())
+
+    baseline, baseline_secs = time_call(baseline_points_string_to_xy_list,
+                                        points)
+    result, secs = time_call(Kymograph.points_string_to_xy_array, points)
+    assert np.array_equal(np.array(baseline), result)
+    report("parse 1 polygon", baseline_secs, secs, args.points)
+
+    string, baseline_secs = time_call(baseline_xy_to_points_string,
+                                      xy.tolist())
+    result, secs = time_call(Kymograph.xy_array_to_points_string, xy, ", ")
+    assert string == result
+    report("format 1 polygon", baseline_secs, secs, args.points)
+
+    # Many polylines, parsed one at a time or all together
+    strings = []
+    for i in range(args.shapes):
+        shape_xy = np.round(rng.uniform(0, 4096, (args.shape_points, 2)), 2)
+        strings.append("points[%s]"
+                       % baseline_xy_to_points_string(shape_xy.tolist()))
+    point_count = args.shapes * args.shape_points
+
+    baseline, baseline_secs = time_call(
+        lambda: [baseline_points_string_to_xy_list(s) for s in strings])
+    result, secs = time_call(Kymograph.points_strings_to_xy_arrays, strings)
+    assert all(np.array_equal(np.array(b), r)
+               for b, r in zip(baseline, result))
+    report("parse %s polylines" % args.shapes, baseline_secs, secs,
+           point_count)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
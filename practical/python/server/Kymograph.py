@@ -38,194 +38,502 @@ from omero.gateway import BlitzGateway
 import omero
 import omero.util.script_utils as script_utils
 from omero.rtypes import rlong, rstring, robject, unwrap
+from omero.sys import ParametersI
 import omero.scripts as scripts
-from numpy import zeros, hstack, vstack, asarray, math
+from numpy import zeros, hstack, asarray, arange, floor, rint, \
+    issubdtype, integer, concatenate, dtype, fromstring, split, cumsum
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import math
+import multiprocessing
 import logging
 from PIL import Image
-from cStringIO import StringIO
+from io import BytesIO
 
 logger = logging.getLogger('kymograph')
 
+# Sample lines from the raw pixel data, or from rendered 8-bit images
+RAW_DATA = "Raw"
+RENDERED_DATA = "Rendered"
 
-def get_line_data(image, x1, y1, x2, y2, line_w=2, the_z=0, the_c=0, the_t=0):
+# numpy dtypes of OMERO pixels types that have different names
+PIXELS_DTYPES = {"float": "float32", "double": "float64"}
+
+# Number of ROIs in each job of the process pool, if Max_Workers > 1
+ROIS_PER_JOB = 8
+
+
+def get_line_coords(x1, y1, x2, y2, line_w=2):
     """
-    Grab pixel data covering the specified line, and rotates it horizontally.
+    Get the coordinates to sample along the line, across its width.
 
-    Uses current rendering settings and returns 8-bit data.
-    Rotates it so that x1,y1 is to the left,
-    Returning a numpy 2d array. Used by Kymograph.py script.
-    Uses PIL to handle rotating and interpolating the data. Converts to numpy
-    to PIL and back (may change dtype.)
+    Returns (xs, ys), 2d numpy arrays of shape (line_w, length) with x1,y1
+    at the left of the middle row, ordered as if the line was rotated to
+    be horizontal.
 
-    @param pixels:          PixelsWrapper object
     @param x1, y1, x2, y2:  Coordinates of line
     @param line_w:          Width of the line we want
-    @param the_z:           Z index within pixels
-    @param the_c:           Channel index
-    @param the_t:           Time index
     """
-    size_x = image.getSizeX()
-    size_y = image.getSizeY()
-
     line_x = x2 - x1
     line_y = y2 - y1
-
+    length = int(math.sqrt(math.pow(line_x, 2) + math.pow(line_y, 2)))
     rads = math.atan2(line_y, line_x)
+    cos, sin = math.cos(rads), math.sin(rads)
+
+    along = arange(length)
+    across = (arange(line_w) - (line_w - 1) / 2.0).reshape(-1, 1)
+    xs = x1 + along * cos - across * sin
+    ys = y1 + along * sin + across * cos
+    return xs, ys
+
+
+def get_region_bbox(xs, ys, size_x, size_y):
+    """
+    Get the region of the image needed to sample at xs, ys.
+
+    Returns (x, y, w, h), clipped to the image and at least 1 pixel.
+    """
+    if xs.size == 0:
+        return 0, 0, 1, 1
+    x = min(max(int(math.floor(xs.min())), 0), size_x - 1)
+    y = min(max(int(math.floor(ys.min())), 0), size_y - 1)
+    right = min(max(int(math.floor(xs.max())) + 2, x + 1), size_x)
+    bottom = min(max(int(math.floor(ys.max())) + 2, y + 1), size_y)
+    return x, y, right - x, bottom - y
+
 
-    # How much extra Height do we need, top and bottom?
-    extra_h = abs(math.sin(rads) * line_w)
-    bottom = int(max(y1, y2) + extra_h/2)
-    top = int(min(y1, y2) - extra_h/2)
-
-    # How much extra width do we need, left and right?
-    extra_w = abs(math.cos(rads) * line_w)
-    left = int(min(x1, x2) - extra_w)
-    right = int(max(x1, x2) + extra_w)
-
-    # What's the larger area we need? - Are we outside the image?
-    pad_left, pad_right, pad_top, pad_bottom = 0, 0, 0, 0
-    if left < 0:
-        pad_left = abs(left)
-        left = 0
-    x = left
-    if top < 0:
-        pad_top = abs(top)
-        top = 0
-    y = top
-    if right > size_x:
-        pad_right = right-size_x
-        right = size_x
-    w = int(right - left)
-    if bottom > size_y:
-        pad_bottom = bottom-size_y
-        bottom = size_y
-    h = int(bottom - top)
+def get_region_data(image, x, y, w, h, the_z=0, the_c=0, the_t=0, raw=True):
+    """
+    Get a region of a single plane as a 2d numpy array.
 
+    If raw, reads the raw pixel data with getTile(), at the Image's pixel
+    type. Otherwise uses current rendering settings and returns 8-bit data.
+    """
+    if raw:
+        pixels = image.getPrimaryPixels()
+        return pixels.getTile(the_z, the_c, the_t, (x, y, w, h))
     # get the Tile - render single channel white
     image.set_active_channels([the_c + 1], None, ['FFFFFF'])
     jpeg_data = image.renderJpegRegion(the_z, the_t, x, y, w, h)
-    pil = Image.open(StringIO(jpeg_data))
+    rgb_plane = asarray(Image.open(BytesIO(jpeg_data)).convert('RGB'))
+    # greyscale image. r, g, b all same. Just use first
+    return rgb_plane[::, ::, 0]
 
-    # pad if we wanted a bigger region
-    if pad_left > 0 or pad_right > 0 or pad_top > 0 or pad_bottom > 0:
-        img_w, img_h = pil.size
-        new_w = img_w + pad_left + pad_right
-        new_h = img_h + pad_top + pad_bottom
-        canvas = Image.new('RGB', (new_w, new_h), '#ff0000')
-        canvas.paste(pil, (pad_left, pad_top))
-        pil = canvas
 
-    # Now need to rotate so that x1,y1 is horizontally to the left of x2,y2
-    to_rotate = math.degrees(rads)
+def sample_bilinear(data, xs, ys):
+    """
+    Sample 2d data at xs, ys with bilinear interpolation.
 
-    # filter=Image.BICUBIC see
-    # http://www.ncbi.nlm.nih.gov/pmc/articles/PMC2172449/
-    rotated = pil.rotate(to_rotate, expand=True)
+    Samples outside data are 0. Returns data of the same dtype as data,
+    with the same shape as xs.
+    """
+    size_y, size_x = data.shape
+    x0 = floor(xs).astype(int)
+    y0 = floor(ys).astype(int)
+    fx = xs - x0
+    fy = ys - y0
+    values = zeros(xs.shape)
+    for dy, wy in ((0, 1 - fy), (1, fy)):
+        for dx, wx in ((0, 1 - fx), (1, fx)):
+            xi = x0 + dx
+            yi = y0 + dy
+            inside = (xi >= 0) & (xi < size_x) & (yi >= 0) & (yi < size_y)
+            values[inside] += (wx * wy)[inside] * data[yi[inside], xi[inside]]
+    if issubdtype(data.dtype, integer):
+        values = rint(values)
+    return values.astype(data.dtype)
+
+
+def get_segment_coords(points, line_w=2):
+    """
+    Get the sample coordinates for each segment of a polyline.
 
-    # finally we need to crop to the length of the line
-    length = int(math.sqrt(math.pow(line_x, 2) + math.pow(line_y, 2)))
-    rot_w, rot_h = rotated.size
-    crop_x = (rot_w - length)/2
-    crop_x2 = crop_x + length
-    crop_y = (rot_h - line_w)/2
-    crop_y2 = crop_y + line_w
-    cropped = rotated.crop((crop_x, crop_y, crop_x2, crop_y2))
-
-    # return numpy array
-    rgb_plane = asarray(cropped)
-    # greyscale image. r, g, b all same. Just use first
-    return rgb_plane[::, ::, 0]
+    Returns list of (xs, ys) from get_line_coords().
+    """
+    coords = []
+    for point in range(len(points)-1):
+        x1, y1 = points[point]
+        x2, y2 = points[point+1]
+        coords.append(get_line_coords(x1, y1, x2, y2, line_w))
+    return coords
+
+
+def get_coords_bbox(coords, size_x, size_y):
+    """Get the union region of the image needed for all (xs, ys) coords."""
+    xs = concatenate([c[0].ravel() for c in coords])
+    ys = concatenate([c[1].ravel() for c in coords])
+    return get_region_bbox(xs, ys, size_x, size_y)
+
+
+def get_region_planes(image, x, y, w, h, the_z=0, the_t=0, raw=True):
+    """
+    Get a region of a plane for all channels, as a 3d numpy array (c, y, x).
+
+    If raw, all channels are read with a single getTiles() call.
+    """
+    size_c = image.getSizeC()
+    if raw:
+        pixels = image.getPrimaryPixels()
+        zct_list = [(the_z, the_c, the_t, (x, y, w, h))
+                    for the_c in range(size_c)]
+        return asarray(list(pixels.getTiles(zct_list)))
+    return asarray([get_region_data(image, x, y, w, h, the_z, the_c, the_t,
+                                    raw=False)
+                    for the_c in range(size_c)])
 
 
-def points_string_to_xy_list(string):
+def sample_region(region, bbox, coords):
     """
-    Convert string to list of (x,y) points.
+    Sample each channel of a region at coords, joining segments in a row.
+
+    @param region:      3d array (c, y, x) from get_region_planes()
+    @param bbox:        (x, y, w, h) of the region in the image
+    @param coords:      list of (xs, ys) for each segment
+    Returns list of 2d rows, one for each channel.
+    """
+    x, y = bbox[0], bbox[1]
+    return [hstack([sample_bilinear(plane, xs - x, ys - y)
+                    for xs, ys in coords])
+            for plane in region]
+
+
+def get_line_data(image, x1, y1, x2, y2, line_w=2, the_z=0, the_c=0, the_t=0,
+                  raw=True):
+    """
+    Grab pixel data covering the specified line, and rotates it horizontally.
+
+    If raw, reads the raw pixel data with getTile() and returns data of the
+    Image's pixel type. Otherwise uses current rendering settings and returns
+    8-bit data.
+    Rotates it so that x1,y1 is to the left,
+    Returning a numpy 2d array. Used by Kymograph.py script.
+    Only the line_w x length points along the line are interpolated, with
+    bilinear interpolation, so the cost doesn't depend on the line angle.
+
+    @param image:           ImageWrapper object
+    @param x1, y1, x2, y2:  Coordinates of line
+    @param line_w:          Width of the line we want
+    @param the_z:           Z index within pixels
+    @param the_c:           Channel index
+    @param the_t:           Time index
+    @param raw:             If True, sample raw data instead of rendered data
+    """
+    xs, ys = get_line_coords(x1, y1, x2, y2, line_w)
+    x, y, w, h = get_region_bbox(xs, ys, image.getSizeX(), image.getSizeY())
+    data = get_region_data(image, x, y, w, h, the_z, the_c, the_t, raw)
+    return sample_bilinear(data, xs - x, ys - y)
+
+
+# Points codec, for both OMERO points formats. OMERO scripts are uploaded
+# as single files, so Kymograph_Analysis.py, batch_roi_export_to_table.py
+# and copy_masks_2_polygons.py keep identical copies of the functions they
+# use. benchmarks/benchmark_points.py times the functions here.
+def points_string_to_coords(string):
+    """
+    Get the coordinates text from a points string, as "x,y x,y".
+
+    Handles "points[309,427, 366,503]" and "309,427 366,503" formats.
+    """
+    string = string.strip()
+    if string.startswith("points"):
+        start = string.find("[")
+        end = string.find("]", start)
+        if start < 0 or end < 0:
+            raise ValueError(
+                "Unrecognised ROI shape 'points' string: %s" % string)
+        string = string[start + 1:end]
+    return string.replace(", ", " ")
+
+
+def coords_to_xy_array(coords):
+    """Parse "x,y x,y" coordinates text into a (N, 2) float numpy array."""
+    values = fromstring(coords.replace(",", " "), sep=" ")
+    # Each point has one comma between x and y
+    if values.size != 2 * coords.count(","):
+        raise ValueError("Unrecognised ROI shape 'points' string: %s"
+                         % coords[:100])
+    return values.reshape(-1, 2)
+
+
+def points_string_to_xy_array(string):
+    """
+    Convert string to (N, 2) numpy array of x, y points.
 
     Expects string in format generated from omero.model.ShapeI.getPoints()
-    e.g. "points[309,427, 366,503]" to [(309,427), (366,503)]
-    """
-    point_lists = string.strip().split("points")
-    if len(point_lists) < 2:
-        if len(point_lists) == 1 and point_lists[0]:
-            xys = point_lists[0].split()
-            xy_list = [tuple(map(float, xy.split(','))) for xy in xys]
-            return xy_list
+    e.g. "points[309,427, 366,503]" or "309,427 366,503" to
+    array([[309., 427.], [366., 503.]])
+    """
+    coords = points_string_to_coords(string)
+    if not coords:
         raise ValueError("Unrecognised ROI shape 'points' string: %s" % string)
+    return coords_to_xy_array(coords)
 
-    first_list = point_lists[1]
-    xy_list = []
-    for xy in first_list.strip(" []").split(", "):
-        x, y = xy.split(",")
-        xy_list.append((float(x.strip()), float(y.strip())))
-    return xy_list
 
+def points_strings_to_xy_arrays(strings):
+    """
+    Convert many points strings to (N, 2) numpy arrays, parsing them together.
 
-def polyline_kymograph(conn, script_params, image, polylines, line_width,
-                       dataset):
+    Returns list of arrays, one for each string.
     """
-    Create a new kymograph Image from one or more polylines.
+    all_coords = []
+    for string in strings:
+        coords = points_string_to_coords(string)
+        if not coords:
+            raise ValueError(
+                "Unrecognised ROI shape 'points' string: %s" % string)
+        all_coords.append(coords)
+    if not all_coords:
+        return []
+    counts = [coords.count(",") for coords in all_coords]
+    xy = coords_to_xy_array(" ".join(all_coords))
+    return split(xy, cumsum(counts)[:-1])
+
+
+def xy_array_to_points_string(xy, separator=" "):
+    """
+    Convert (N, 2) array of x, y points to a points string.
 
-    @param polylines:       map of theT: {theZ:theZ, points: list of (x,y)}
+    e.g. array([[309, 427], [366, 503]]) to "309,427 366,503", or
+    "309,427, 366,503" with separator ", "
     """
-    size_c = image.getSizeC()
-    size_t = image.getSizeT()
+    template = separator.join(["%s,%s"] * len(xy))
+    return template % tuple(asarray(xy).ravel().tolist())
 
-    use_all_times = "Use_All_Timepoints" in script_params and \
-        script_params['Use_All_Timepoints'] is True
-    if len(polylines) == 1:
-        use_all_times = True
 
-    # for now, assume we're using ALL timepoints
-    # need the first shape
-    first_shape = None
+def get_shape_coords(shape, line_w=2):
+    """Get the sample coordinates for each segment of a line or polyline."""
+    if 'points' in shape:
+        return get_segment_coords(shape['points'], line_w)
+    return [get_line_coords(shape['x1'], shape['y1'], shape['x2'],
+                            shape['y2'], line_w)]
+
+
+def get_union_bbox(bboxes):
+    """Get the region (x, y, w, h) covering all the bboxes."""
+    x = min([bbox[0] for bbox in bboxes])
+    y = min([bbox[1] for bbox in bboxes])
+    right = max([bbox[0] + bbox[2] for bbox in bboxes])
+    bottom = max([bbox[1] + bbox[3] for bbox in bboxes])
+    return x, y, right - x, bottom - y
+
+
+def get_first_shape(shapes, size_t):
+    """Get the shape at the first timepoint that has one."""
     for t in range(size_t):
-        if t in polylines:
-            first_shape = polylines[t]
-            break
-
-    def plane_gen():
-        """Final image is single Z and T. Each plane is rows of T-slices."""
-        for the_c in range(size_c):
-            shape = first_shape
-            t_rows = []
-            for the_t in range(size_t):
-                # update shape if specified for this timepoint
-                if the_t in polylines:
-                    shape = polylines[the_t]
-                elif not use_all_times:
-                    continue
-                line_data = []
-                points = shape['points']
-                the_z = shape['theZ']
-                for point in range(len(points)-1):
-                    x1, y1 = points[point]
-                    x2, y2 = points[point+1]
-                    ld = get_line_data(image, x1, y1, x2, y2,
-                                       line_width, the_z, the_c, the_t)
-                    line_data.append(ld)
-                row_data = hstack(line_data)
-                t_rows.append(row_data)
-
-            # have to handle any mismatch in line lengths by padding shorter
-            # rows
-            longest = max([row_array.shape[1] for row_array in t_rows])
-            for t in range(len(t_rows)):
-                t_row = t_rows[t]
-                row_height, row_length = t_row.shape
-                if row_length < longest:
-                    padding = longest - row_length
-                    pad_data = zeros((row_height, padding), dtype=t_row.dtype)
-                    t_rows[t] = hstack([t_row, pad_data])
-            c_data = vstack(t_rows)
-            yield c_data
+        if t in shapes:
+            return shapes[t]
+
+
+def sample_kymographs(image, tracks, line_width, use_all_times, raw,
+                      writers):
+    """
+    Sample the kymograph rows of every ROI of an image in one pass over T.
+
+    At each timepoint, the union region of all the shapes on each Z is read
+    once for all channels, and every shape is sampled from it.
+
+    @param tracks:          list of maps of theT: line or polyline, one for
+                            each ROI
+    @param use_all_times:   If True, use every timepoint with the last shape
+                            of each ROI. ROIs with a single shape always use
+                            every timepoint
+    @param raw:             If True, sample raw data instead of rendered data
+    @param writers:         KymographWriter for each track. Rows are added
+                            to it as they are sampled
+    """
+    size_x = image.getSizeX()
+    size_y = image.getSizeY()
+    size_t = image.getSizeT()
+
+    shapes = [get_first_shape(track, size_t) for track in tracks]
+    coords = [None] * len(tracks)
+    bboxes = [None] * len(tracks)
+    for the_t in range(size_t):
+        # Find the shape of each track at this timepoint, grouped by Z
+        by_z = defaultdict(list)
+        for i, track in enumerate(tracks):
+            if the_t in track:
+                shapes[i] = track[the_t]
+                coords[i] = None
+            elif not use_all_times and len(track) > 1:
+                continue
+            if coords[i] is None:
+                coords[i] = get_shape_coords(shapes[i], line_width)
+                bboxes[i] = get_coords_bbox(coords[i], size_x, size_y)
+            by_z[shapes[i]['theZ']].append(i)
+
+        for the_z, indexes in by_z.items():
+            bbox = get_union_bbox([bboxes[i] for i in indexes])
+            x, y, w, h = bbox
+            region = get_region_planes(image, x, y, w, h, the_z, the_t, raw)
+            for i in indexes:
+                for the_c, row_data in enumerate(
+                        sample_region(region, bbox, coords[i])):
+                    writers[i].add(the_c, row_data)
+
+
+def get_kymograph_size(track, line_width, use_all_times, size_t):
+    """
+    Get the (size_x, size_y) of the kymograph of a track.
+
+    Rows of lines are cropped or padded to the length of the first line.
+    Rows of polylines are padded to the length of the longest polyline.
+    """
+    first_shape = get_first_shape(track, size_t)
+    if 'points' in first_shape:
+        size_x = max([sum([xs.shape[1] for xs, ys in
+                           get_shape_coords(shape, line_width)])
+                      for shape in track.values()])
+    else:
+        size_x = get_shape_coords(first_shape, line_width)[0][0].shape[1]
+    if use_all_times or len(track) == 1:
+        time_count = size_t
+    else:
+        time_count = len([t for t in track if t < size_t])
+    return size_x, time_count * line_width
+
+
+class KymographWriter(object):
+    """
+    Write the rows of a kymograph to a new Image as they are sampled.
+
+    The Image is created up front and each row band is written with
+    setTile(), so only one band is held in memory at a time.
+    """
+
+    def __init__(self, conn, name, description, size_x, size_y, size_c,
+                 pixels_type, dataset=None):
+        """Create the new single Z and T Image, with pixels_type data."""
+        self.conn = conn
+        self.size_x = size_x
+        # Rows are written big-endian, as expected by RawPixelsStore
+        self.dtype = dtype(PIXELS_DTYPES.get(pixels_type, pixels_type))\
+            .newbyteorder('>')
+        query_service = conn.getQueryService()
+        p_type = query_service.findByQuery(
+            "from PixelsType as p where p.value='%s'" % pixels_type, None)
+        image_id = conn.getPixelsService().createImage(
+            max(size_x, 1), max(size_y, 1), 1, 1, list(range(size_c)),
+            p_type, name, description, conn.SERVICE_OPTS).getValue()
+        self.image_id = image_id
+        self.pixels_id = conn.getObject("Image", image_id)\
+            .getPrimaryPixels().getId()
+        self.store = conn.c.sf.createRawPixelsStore()
+        self.store.setPixelsId(self.pixels_id, True, conn.SERVICE_OPTS)
+
+        if dataset is not None:
+            link = omero.model.DatasetImageLinkI()
+            link.parent = omero.model.DatasetI(dataset.getId(), False)
+            link.child = omero.model.ImageI(image_id, False)
+            conn.getUpdateService().saveObject(link, conn.SERVICE_OPTS)
+
+        # next row to write, min and max of each channel
+        self.offsets = [0] * size_c
+        self.min_max = [None] * size_c
+
+    def add(self, the_c, row_data):
+        """Write the next row band of channel the_c, cropped or padded."""
+        row_height, row_length = row_data.shape
+        if row_length > self.size_x:
+            row_data = row_data[:, 0:self.size_x]
+        elif row_length < self.size_x:
+            padding = self.size_x - row_length
+            pad_data = zeros((row_height, padding), dtype=row_data.dtype)
+            row_data = hstack([row_data, pad_data])
+        if self.size_x == 0:
+            return
+        band = row_data.astype(self.dtype)
+        self.store.setTile(band.tobytes(), 0, the_c, 0, 0,
+                           self.offsets[the_c], self.size_x, row_height,
+                           self.conn.SERVICE_OPTS)
+        self.offsets[the_c] += row_height
+        band_min, band_max = float(band.min()), float(band.max())
+        if self.min_max[the_c] is not None:
+            band_min = min(band_min, self.min_max[the_c][0])
+            band_max = max(band_max, self.min_max[the_c][1])
+        self.min_max[the_c] = (band_min, band_max)
+
+    def abort(self):
+        """Close the store and delete the unfinished Image."""
+        try:
+            self.store.close()
+        finally:
+            self.conn.deleteObjects("Image", [self.image_id], wait=True)
+
+    def close(self):
+        """Close the store, save channel min and max and return the Image."""
+        self.store.close()
+        pixels_service = self.conn.getPixelsService()
+        for the_c, min_max in enumerate(self.min_max):
+            if min_max is not None:
+                pixels_service.setChannelGlobalMinMax(
+                    self.pixels_id, the_c, min_max[0], min_max[1],
+                    self.conn.SERVICE_OPTS)
+        return self.conn.getObject("Image", self.image_id)
+
+
+def create_kymograph_writer(conn, image, track, line_width, use_all_times,
+                            pixels_type, dataset):
+    """Create a KymographWriter for the kymograph of a line or polyline."""
+    size_t = image.getSizeT()
+    first_shape = get_first_shape(track, size_t)
+    size_x, size_y = get_kymograph_size(track, line_width, use_all_times,
+                                        size_t)
 
     name = "%s_kymograph" % image.getName()
-    desc = "Kymograph generated from Image ID: %s, polyline: %s" \
-        % (image.getId(), first_shape['points'])
+    if 'points' in first_shape:
+        desc = "Kymograph generated from Image ID: %s, polyline: %s" \
+            % (image.getId(), first_shape['points'])
+    else:
+        desc = "Kymograph generated from Image ID: %s, line: %s" \
+            % (image.getId(), first_shape)
     desc += "\nwith each timepoint being %s vertical pixels" % line_width
-    return conn.createImageFromNumpySeq(
-        plane_gen(), name, 1, size_c, 1, description=desc,
-        dataset=dataset)
+    return KymographWriter(conn, name, desc, size_x, size_y,
+                           image.getSizeC(), pixels_type, dataset)
+
+
+def tracks_kymographs(conn, script_params, image, tracks, line_width,
+                      dataset):
+    """
+    Create a new kymograph Image for each track of lines or polylines.
+
+    All tracks are sampled in a single pass over T, and their rows streamed
+    to the new Images.
+
+    @param tracks:          list of maps of theT: line or polyline
+    """
+    use_all_times = "Use_All_Timepoints" in script_params and \
+        script_params['Use_All_Timepoints'] is True
+    raw = script_params.get("Pixel_Data", RAW_DATA) == RAW_DATA
+    pixels_type = image.getPixelsType() if raw else "uint8"
+    if pixels_type == "bit":
+        pixels_type = "uint8"
+
+    writers = []
+    try:
+        for track in tracks:
+            writers.append(create_kymograph_writer(
+                conn, image, track, line_width, use_all_times, pixels_type,
+                dataset))
+        sample_kymographs(image, tracks, line_width, use_all_times, raw,
+                          writers)
+    except Exception:
+        # Don't leave open stores or unfinished Images behind
+        for writer in writers:
+            writer.abort()
+        raise
+    return [writer.close() for writer in writers]
+
+
+def polyline_kymograph(conn, script_params, image, polylines, line_width,
+                       dataset):
+    """
+    Create a new kymograph Image from one or more polylines.
+
+    @param polylines:       map of theT: {theZ:theZ, points: list of (x,y)}
+    """
+    return tracks_kymographs(conn, script_params, image, [polylines],
+                             line_width, dataset)[0]
 
 
 def lines_kymograph(conn, script_params, image, lines, line_width, dataset):
@@ -237,64 +545,202 @@ def lines_kymograph(conn, script_params, image, lines, line_width, dataset):
     for x1,y1 and direction, making all subsequent lines the same length as
     the first.
     """
-    size_c = image.getSizeC()
+    return tracks_kymographs(conn, script_params, image, [lines],
+                             line_width, dataset)[0]
+
+
+def get_roi_track(roi):
+    """
+    Get the lines or polylines of an ROI, as a map of theT: shape.
+
+    Returns None if the ROI has no Line or Polyline.
+    """
+    lines = {}          # map of theT: line
+    polylines = {}      # map of theT: polyline
+    for s in roi.copyShapes():
+        if s is None:
+            continue
+        the_t = unwrap(s.getTheT())
+        the_z = unwrap(s.getTheZ())
+        z = 0
+        t = 0
+        if the_t is not None:
+            t = the_t
+        if the_z is not None:
+            z = the_z
+        # TODO: Add some filter of shapes. E.g. text? / 'lines' only
+        # etc.
+        if type(s) == omero.model.LineI:
+            x1 = s.getX1().getValue()
+            x2 = s.getX2().getValue()
+            y1 = s.getY1().getValue()
+            y2 = s.getY2().getValue()
+            lines[t] = {'theZ': z, 'x1': x1, 'y1': y1, 'x2': x2,
+                        'y2': y2}
+
+        elif type(s) == omero.model.PolylineI:
+            v = s.getPoints().getValue()
+            polylines[t] = {'theZ': z, 'points': v}
+
+    if len(lines) > 0:
+        return lines
+    elif len(polylines) > 0:
+        # Parse the points of all the polylines together, as (x,y) lists
+        all_xy = points_strings_to_xy_arrays(
+            [polyline['points'] for polyline in polylines.values()])
+        for polyline, xy in zip(polylines.values(), all_xy):
+            polyline['points'] = [tuple(point) for point in xy.tolist()]
+        return polylines
+    return None
+
+
+def get_kymograph_metadata(image, script_params):
+    """
+    Get the channel names and colors, pixel size and time interval of image.
+
+    These are set on each kymograph created from image.
+    """
+    c_names = []
+    colors = []
+    for ch in image.getChannels():
+        c_names.append(ch.getLabel())
+        colors.append(ch.getColor().getRGB())
+
     size_t = image.getSizeT()
+    pixels = image.getPrimaryPixels()
+
+    # look-up the interval for each time-point
+    t_interval = None
+    infos = list(pixels.copyPlaneInfo(theC=0, theT=size_t-1, theZ=0))
+    if len(infos) > 0 and infos[0].getDeltaT() is not None:
+        duration = infos[0].getDeltaT(units="SECOND").getValue()
+        if size_t == 1:
+            t_interval = duration
+        else:
+            t_interval = duration/(size_t-1)
+    elif pixels.timeIncrement is not None:
+        t_interval = pixels.timeIncrement
+    elif "Time_Increment" in script_params:
+        t_interval = script_params["Time_Increment"]
 
-    use_all_times = "Use_All_Timepoints" in script_params and \
-        script_params['Use_All_Timepoints'] is True
-    if len(lines) == 1:
-        use_all_times = True
+    pixel_size = None
+    if pixels.physicalSizeX is not None:
+        pixel_size = pixels.physicalSizeX
+    elif "Pixel_Size" in script_params:
+        pixel_size = script_params['Pixel_Size']
 
-    # need the first shape - Going to make all lines this length
-    first_line = None
-    for t in range(size_t):
-        if t in lines:
-            first_line = lines[t]
-            break
-
-    def plane_gen():
-        """Final image is single Z and T. Each plane is rows of T-slices."""
-        for the_c in range(size_c):
-            shape = first_line
-            r_length = None           # set this for first line
-            t_rows = []
-            for the_t in range(size_t):
-                if the_t in lines:
-                    shape = lines[the_t]
-                elif not use_all_times:
-                    continue
-                the_z = shape['theZ']
-                x1, y1, x2, y2 = shape['x1'], shape['y1'], shape['x2'], \
-                    shape['y2']
-                row_data = get_line_data(
-                    image, x1, y1, x2, y2, line_width,
-                    the_z, the_c, the_t)
-                # if the row is too long, crop - if it's too short, pad
-                row_height, row_length = row_data.shape
-                if r_length is None:
-                    r_length = row_length
-                if row_length < r_length:
-                    padding = r_length - row_length
-                    pad_data = zeros((row_height, padding),
-                                     dtype=row_data.dtype)
-                    row_data = hstack([row_data, pad_data])
-                elif row_length > r_length:
-                    row_data = row_data[:, 0:r_length]
-                t_rows.append(row_data)
-            yield vstack(t_rows)
+    return {'c_names': c_names, 'colors': colors, 't_interval': t_interval,
+            'pixel_size': pixel_size,
+            'group_id': image.getDetails().getGroup().getId()}
 
-    name = "%s_kymograph" % image.getName()
-    desc = "Kymograph generated from Image ID: %s, line: %s" \
-        % (image.getId(), first_line)
-    desc += "\nwith each timepoint being %s vertical pixels" % line_width
-    return conn.createImageFromNumpySeq(
-        plane_gen(), name, 1, size_c, 1, description=desc,
-        dataset=dataset)
+
+def save_kymograph_metadata(conn, kymographs, line_width):
+    """
+    Save channel names, colors and pixel sizes on all the new images.
+
+    The Pixels of all new images in a group are loaded with their Channels
+    in one query, updated and saved with one saveArray() call, then the
+    rendering settings of all of them are reset together.
+
+    @param kymographs:  list of (new image IDs, metadata) where metadata is
+                        from get_kymograph_metadata() for the source image
+    """
+    metadata_by_id = {}
+    ids_by_group = defaultdict(list)
+    for image_ids, metadata in kymographs:
+        for image_id in image_ids:
+            metadata_by_id[image_id] = metadata
+            ids_by_group[metadata['group_id']].append(image_id)
+
+    microm = getattr(omero.model.enums.UnitsLength, "MICROMETER")
+    for group_id, image_ids in ids_by_group.items():
+        ctx = conn.SERVICE_OPTS.copy()
+        ctx.setOmeroGroup(group_id)
+        params = ParametersI()
+        params.addIds(image_ids)
+        query = "select distinct p from Pixels p join fetch p.channels as c" \
+                " join fetch c.logicalChannel where p.image.id in (:ids)"
+        all_pixels = conn.getQueryService().findAllByQuery(query, params, ctx)
+        for px in all_pixels:
+            metadata = metadata_by_id[px.getImage().getId().getValue()]
+            # Save channel names and colors
+            for i, c in enumerate(px.copyChannels()):
+                c.getLogicalChannel().setName(
+                    rstring(metadata['c_names'][i]))
+                r, g, b = metadata['colors'][i]
+                c.red = omero.rtypes.rint(r)
+                c.green = omero.rtypes.rint(g)
+                c.blue = omero.rtypes.rint(b)
+                c.alpha = omero.rtypes.rint(255)
+
+            # If we know pixel sizes, set them on the new image
+            pixel_size = metadata['pixel_size']
+            t_interval = metadata['t_interval']
+            if pixel_size is not None:
+                px.setPhysicalSizeX(omero.model.LengthI(pixel_size, microm))
+            if t_interval is not None:
+                t_per_pixel = t_interval / line_width
+                px.setPhysicalSizeY(omero.model.LengthI(t_per_pixel, microm))
+        conn.getUpdateService().saveArray(all_pixels, ctx)
+        # reset based on colors above
+        conn.getRenderingSettingsService().resetDefaultsInSet(
+            "Image", image_ids, ctx)
+
+
+def kymograph_job(property_map, session_key, script_params, image_id,
+                  dataset_id, tracks):
+    """
+    Create kymographs for some of the ROI tracks of an image, in a worker.
+
+    The worker process joins the session of the script with its own client.
+    Returns the IDs of the new Images.
+    """
+    client = omero.client(pmap=property_map)
+    try:
+        client.joinSession(session_key)
+        conn = BlitzGateway(client_obj=client)
+        conn.SERVICE_OPTS.setOmeroGroup(-1)
+        image = conn.getObject("Image", image_id)
+        # Create the kymographs in the group of the image
+        conn.SERVICE_OPTS.setOmeroGroup(image.getDetails().getGroup().getId())
+        dataset = None
+        if dataset_id is not None:
+            dataset = conn.getObject("Dataset", dataset_id)
+        new_images = tracks_kymographs(
+            conn, script_params, image, tracks, script_params['Line_Width'],
+            dataset)
+        return [img.getId() for img in new_images]
+    finally:
+        # Only leaves the session, which the script is still using
+        client.closeSession()
+
+
+def run_kymograph_jobs(conn, script_params, jobs, max_workers):
+    """
+    Run kymograph jobs of (image, dataset, tracks) in a process pool.
+
+    Workers are spawned, not forked, since forking the threads of the
+    script's Ice client can deadlock the worker.
+    Returns list of the new Images of each job.
+    """
+    property_map = conn.c.getPropertyMap()
+    session_key = conn.c.getSessionId()
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             mp_context=mp_context) as executor:
+        futures = [executor.submit(
+            kymograph_job, property_map, session_key, script_params,
+            image.getId(), dataset.getId() if dataset is not None else None,
+            tracks) for image, dataset, tracks in jobs]
+        new_image_ids = [future.result() for future in futures]
+    return [list(conn.getObjects("Image", ids)) if ids else []
+            for ids in new_image_ids]
 
 
 def process_images(conn, script_params):
     """Process each image passed to script, generating new Kymograph images."""
     line_width = script_params['Line_Width']
+    max_workers = script_params.get("Max_Workers", 1)
     new_kymographs = []
     message = ""
 
@@ -311,18 +757,12 @@ def process_images(conn, script_params):
         message += "No ROI containing line or polyline was found."
         return None, message
 
+    jobs = []           # (image, dataset, tracks) to create kymographs for
+    metadata = {}       # metadata of each image, to set on its kymographs
+    dataset = None
     for image in images:
         if image.getSizeT() == 1:
             continue
-        new_images = []      # kymographs derived from the current image.
-        c_names = []
-        colors = []
-        for ch in image.getChannels():
-            c_names.append(ch.getLabel())
-            colors.append(ch.getColor().getRGB())
-
-        size_t = image.getSizeT()
-        pixels = image.getPrimaryPixels()
 
         dataset = image.getParent()
         if dataset is not None and not dataset.canLink():
@@ -340,94 +780,37 @@ def process_images(conn, script_params):
         # update start and direction
         # 3 - Single polyline. Use this shape for all time points
         # 4 - Many polylines. Use the first one to fix length.
+        tracks = []         # lines or polylines of each ROI
         for roi in result.rois:
-            lines = {}          # map of theT: line
-            polylines = {}      # map of theT: polyline
-            for s in roi.copyShapes():
-                if s is None:
-                    continue
-                the_t = unwrap(s.getTheT())
-                the_z = unwrap(s.getTheZ())
-                z = 0
-                t = 0
-                if the_t is not None:
-                    t = the_t
-                if the_z is not None:
-                    z = the_z
-                # TODO: Add some filter of shapes. E.g. text? / 'lines' only
-                # etc.
-                if type(s) == omero.model.LineI:
-                    x1 = s.getX1().getValue()
-                    x2 = s.getX2().getValue()
-                    y1 = s.getY1().getValue()
-                    y2 = s.getY2().getValue()
-                    lines[t] = {'theZ': z, 'x1': x1, 'y1': y1, 'x2': x2,
-                                'y2': y2}
-
-                elif type(s) == omero.model.PolylineI:
-                    v = s.getPoints().getValue()
-                    points = points_string_to_xy_list(v)
-                    polylines[t] = {'theZ': z, 'points': points}
-
-            if len(lines) > 0:
-                new_img = lines_kymograph(
-                    conn, script_params, image, lines, line_width, dataset)
-                new_images.append(new_img)
-                lines = []
-            elif len(polylines) > 0:
-                new_img = polyline_kymograph(
-                    conn, script_params, image, polylines, line_width, dataset)
-                new_images.append(new_img)
-
-        # look-up the interval for each time-point
-        t_interval = None
-        infos = list(pixels.copyPlaneInfo(theC=0, theT=size_t-1, theZ=0))
-        if len(infos) > 0 and infos[0].getDeltaT() is not None:
-            duration = infos[0].getDeltaT(units="SECOND").getValue()
-            if size_t == 1:
-                t_interval = duration
-            else:
-                t_interval = duration/(size_t-1)
-        elif pixels.timeIncrement is not None:
-            t_interval = pixels.timeIncrement
-        elif "Time_Increment" in script_params:
-            t_interval = script_params["Time_Increment"]
-
-        pixel_size = None
-        if pixels.physicalSizeX is not None:
-            pixel_size = pixels.physicalSizeX
-        elif "Pixel_Size" in script_params:
-            pixel_size = script_params['Pixel_Size']
-
-        # Save channel names and colors for each new image
-        for img in new_images:
-            for i, c in enumerate(img.getChannels()):
-                lc = c.getLogicalChannel()
-                lc.setName(c_names[i])
-                lc.save()
-                r, g, b = colors[i]
-                # need to reload channels to avoid optimistic lock on update
-                c_obj = conn.getQueryService().get("Channel", c.id)
-                c_obj.red = omero.rtypes.rint(r)
-                c_obj.green = omero.rtypes.rint(g)
-                c_obj.blue = omero.rtypes.rint(b)
-                c_obj.alpha = omero.rtypes.rint(255)
-                conn.getUpdateService().saveObject(c_obj)
-            img.resetRDefs()  # reset based on colors above
+            track = get_roi_track(roi)
+            if track is not None:
+                tracks.append(track)
+        if not tracks:
+            continue
+        metadata[image.getId()] = get_kymograph_metadata(image, script_params)
 
-            # If we know pixel sizes, set them on the new image
-            if pixel_size is not None or t_interval is not None:
-                px = conn.getQueryService().get("Pixels", img.getPixelsId())
-                microm = getattr(omero.model.enums.UnitsLength, "MICROMETER")
-                if pixel_size is not None:
-                    pixel_size = omero.model.LengthI(pixel_size, microm)
-                    px.setPhysicalSizeX(pixel_size)
-                if t_interval is not None:
-                    t_per_pixel = t_interval / line_width
-                    t_per_pixel = omero.model.LengthI(t_per_pixel, microm)
-                    px.setPhysicalSizeY(t_per_pixel)
-                conn.getUpdateService().saveObject(px)
+        if max_workers > 1:
+            # Split ROIs into jobs for the process pool
+            for i in range(0, len(tracks), ROIS_PER_JOB):
+                jobs.append((image, dataset, tracks[i:i + ROIS_PER_JOB]))
+        else:
+            # Sample all ROIs together, reading each timepoint once
+            jobs.append((image, dataset, tracks))
+
+    if max_workers > 1:
+        job_images = run_kymograph_jobs(conn, script_params, jobs,
+                                        max_workers)
+    else:
+        job_images = [tracks_kymographs(conn, script_params, image, tracks,
+                                        line_width, dataset)
+                      for image, dataset, tracks in jobs]
+
+    kymographs = []
+    for (image, dataset, tracks), new_images in zip(jobs, job_images):
+        kymographs.append(([img.getId() for img in new_images],
+                           metadata[image.getId()]))
         new_kymographs.extend(new_images)
+    save_kymograph_metadata(conn, kymographs, line_width)
 
     if not new_kymographs:
         message += "No kymograph created. See 'Error' or 'Info' for details."
@@ -437,12 +820,12 @@ def process_images(conn, script_params):
         else:
             link_message = ""
 
-        if len(new_images) == 1:
+        if len(new_kymographs) == 1:
             message += "New kymograph created%s: %s." \
-                % (link_message, new_images[0].getName())
-        elif len(new_images) > 1:
+                % (link_message, new_kymographs[0].getName())
+        elif len(new_kymographs) > 1:
             message += "%s new kymographs created%s." \
-                % (len(new_images), link_message)
+                % (len(new_kymographs), link_message)
 
     return new_kymographs, message
 
@@ -475,11 +858,22 @@ same sizeC as input.""",
             "Line_Width", optional=False, grouping="3", default=4,
             description="Width in pixels of each time slice", min=1),
 
+        scripts.String(
+            "Pixel_Data", grouping="3.1", default=RAW_DATA,
+            values=[rstring(RAW_DATA), rstring(RENDERED_DATA)],
+            description="Sample the Raw pixel values, or the Rendered 8-bit"
+            " image using the current rendering settings"),
+
         scripts.Bool(
             "Use_All_Timepoints", grouping="4", default=True,
             description="Use every timepoint in the kymograph. If False, only"
             " use timepoints with ROI-shapes"),
 
+        scripts.Int(
+            "Max_Workers", grouping="4.1", default=1, min=1,
+            description="Number of processes creating kymographs in"
+            " parallel"),
+
         scripts.Float(
             "Time_Increment", grouping="5",
             description="If source movie has no time info, specify increment"
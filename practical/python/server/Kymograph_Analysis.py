@@ -31,35 +31,196 @@ kymograph images that have been created by the 'Kymograph.py' Script.
 from omero.gateway import BlitzGateway
 import omero
 from omero.rtypes import rlong, rstring, robject
-from omero.model import ImageAnnotationLinkI, ImageI
+from omero.model import ImageAnnotationLinkI, ImageI, FileAnnotationI, \
+    OriginalFileI
+from omero.grid import DoubleColumn, ImageColumn, LongColumn, RoiColumn, \
+    StringColumn
+from omero.constants.namespaces import NSBULKANNOTATIONS
 import omero.scripts as scripts
 import omero.util.script_utils as script_utils
+from numpy import fromstring, asarray, absolute, errstate, nan, full
 import logging
 
 logger = logging.getLogger('kymograph_analysis')
 
+# Columns of each segment, in the CSV and the OMERO.table
+SEGMENT_COLUMNS = ["t_start", "x_start", "t_end", "x_end", "dt", "dx", "x_t",
+                   "speed", "avg_x_t", "avg_speed"]
+# Number of rows in each addData() call to the OMERO.table
+TABLE_CHUNK_SIZE = 10000
 
-def points_string_to_xy_list(string):
+
+def points_string_to_coords(string):
     """
-    Convert string to list of (x,y) points.
+    Get the coordinates text from a points string, as "x,y x,y".
+
+    Handles "points[309,427, 366,503]" and "309,427 366,503" formats.
+    """
+    string = string.strip()
+    if string.startswith("points"):
+        start = string.find("[")
+        end = string.find("]", start)
+        if start < 0 or end < 0:
+            raise ValueError(
+                "Unrecognised ROI shape 'points' string: %s" % string)
+        string = string[start + 1:end]
+    return string.replace(", ", " ")
+
+
+def coords_to_xy_array(coords):
+    """Parse "x,y x,y" coordinates text into a (N, 2) float numpy array."""
+    values = fromstring(coords.replace(",", " "), sep=" ")
+    # Each point has one comma between x and y
+    if values.size != 2 * coords.count(","):
+        raise ValueError("Unrecognised ROI shape 'points' string: %s"
+                         % coords[:100])
+    return values.reshape(-1, 2)
+
+
+def points_string_to_xy_array(string):
+    """
+    Convert string to (N, 2) numpy array of x, y points.
 
     Expects string in format generated from omero.model.ShapeI.getPoints()
-    e.g. "points[309,427, 366,503]" to [(309,427), (366,503)]
+    e.g. "points[309,427, 366,503]" or "309,427 366,503" to
+    array([[309., 427.], [366., 503.]])
     """
-    point_lists = string.strip().split("points")
-    if len(point_lists) < 2:
-        if len(point_lists) == 1 and point_lists[0]:
-            xys = point_lists[0].split()
-            xy_list = [tuple(map(float, xy.split(','))) for xy in xys]
-            return xy_list
+    coords = points_string_to_coords(string)
+    if not coords:
         raise ValueError("Unrecognised ROI shape 'points' string: %s" % string)
+    return coords_to_xy_array(coords)
+
+
+def get_segments(xs, ys, microns_per_sec=None):
+    """
+    Get the velocities of each segment of a line or polyline.
+
+    On a kymograph, x is distance (pixels) and y is time (pixels).
+    Returns dict of numpy arrays for SEGMENT_COLUMNS, with one value for each
+    segment. Speeds are NaN if microns_per_sec is not known.
+
+    @param xs, ys:              Coordinates of each vertex
+    @param microns_per_sec:     Speed of 1 pixel in x per pixel in y
+    """
+    xs = asarray(xs, dtype=float)
+    ys = asarray(ys, dtype=float)
+    dx = absolute(xs[1:] - xs[:-1])
+    dy = absolute(ys[1:] - ys[:-1])
+    # Horizontal segments have infinite speed, rather than failing
+    with errstate(divide='ignore', invalid='ignore'):
+        dx_per_y = dx / dy
+        av_x_per_y = absolute((xs[1:] - xs[0]) / (ys[1:] - ys[0]))
+    if microns_per_sec:
+        speed = dx_per_y * microns_per_sec
+        avg_speed = av_x_per_y * microns_per_sec
+    else:
+        speed = full(dx.shape, nan)
+        avg_speed = full(dx.shape, nan)
+    return {"t_start": ys[:-1], "x_start": xs[:-1], "t_end": ys[1:],
+            "x_end": xs[1:], "dt": dy, "dx": dx, "x_t": dx_per_y,
+            "speed": speed, "avg_x_t": av_x_per_y, "avg_speed": avg_speed}
+
+
+def segments_to_csv_rows(segments, col_names, with_speed):
+    """
+    Format segments as CSV rows, one for each segment.
+
+    Speed columns are empty if not with_speed.
+    """
+    columns = []
+    for name in col_names:
+        if name in ("speed", "avg_speed") and not with_speed:
+            columns.append([""] * len(segments[name]))
+        else:
+            columns.append([str(value) for value in segments[name].tolist()])
+    return [",".join(row) for row in zip(*columns)]
+
 
-    first_list = point_lists[1]
-    xy_list = []
-    for xy in first_list.strip(" []").split(", "):
-        x, y = xy.split(",")
-        xy_list.append((float(x.strip()), float(y.strip())))
-    return xy_list
+class SegmentTable(object):
+    """
+    OMERO.table of segment velocities, one row per segment.
+
+    Rows are appended in chunks of chunk_size rows. The table is created
+    when the first rows are added.
+    """
+
+    def __init__(self, conn, table_name, chunk_size=TABLE_CHUNK_SIZE):
+        """Prepare a table, to be created when rows are added."""
+        self.conn = conn
+        self.table_name = table_name
+        self.chunk_size = chunk_size
+        self.table = None
+        self.columns = ["Image", "Roi", "shape_id", "shape_type",
+                        "segment"] + SEGMENT_COLUMNS
+        # values waiting to be added, for each column
+        self.pending = dict((name, []) for name in self.columns)
+
+    def get_columns(self):
+        """Create empty columns of the table."""
+        columns = [ImageColumn("Image", "", []), RoiColumn("Roi", "", []),
+                   LongColumn("shape_id", "", []),
+                   StringColumn("shape_type", "", 16, []),
+                   LongColumn("segment", "", [])]
+        columns.extend(DoubleColumn(name, "", []) for name in SEGMENT_COLUMNS)
+        return columns
+
+    def add(self, image_id, roi_id, shape_id, shape_type, segments):
+        """Add the segments of a shape, appending any complete chunks."""
+        count = len(segments["dx"])
+        self.pending["Image"].extend([image_id] * count)
+        self.pending["Roi"].extend([roi_id] * count)
+        self.pending["shape_id"].extend([shape_id] * count)
+        self.pending["shape_type"].extend([shape_type] * count)
+        self.pending["segment"].extend(range(count))
+        for name in SEGMENT_COLUMNS:
+            self.pending[name].extend(segments[name].tolist())
+        while len(self.pending["Image"]) >= self.chunk_size:
+            self.add_chunk(self.chunk_size)
+
+    def add_chunk(self, size):
+        """Append the first size pending rows to the table."""
+        columns = self.get_columns()
+        if self.table is None:
+            resources = self.conn.c.sf.sharedResources()
+            repository_id = resources.repositories().descriptions[0].getId()\
+                .getValue()
+            self.table = resources.newTable(repository_id, self.table_name)
+            self.table.initialize(columns)
+        for column in columns:
+            values = self.pending[column.name]
+            column.values = values[:size]
+            del values[:size]
+        self.table.addData(columns)
+
+    def close(self):
+        """
+        Append any remaining rows and close the table.
+
+        Returns the FileAnnotation of the table, or None if no rows were added.
+        """
+        if len(self.pending["Image"]) > 0:
+            self.add_chunk(len(self.pending["Image"]))
+        if self.table is None:
+            return None
+        orig_file = self.table.getOriginalFile()
+        self.table.close()
+        file_ann = FileAnnotationI()
+        file_ann.ns = rstring(NSBULKANNOTATIONS)
+        file_ann.file = OriginalFileI(orig_file.id.val, False)
+        return self.conn.getUpdateService().saveAndReturnObject(file_ann)
+
+
+def link_file_annotation(conn, image_ids, file_ann):
+    """Link the FileAnnotation to each Image, in one call."""
+    links = []
+    for iid in image_ids:
+        link = ImageAnnotationLinkI()
+        link.parent = ImageI(iid, False)
+        link.child = file_ann
+        links.append(link)
+    if len(links) > 0:
+        links = conn.getUpdateService().saveAndReturnArray(links)
+    return links
 
 
 def process_images(conn, script_params):
@@ -78,105 +239,100 @@ def process_images(conn, script_params):
         message += "No ROI containing line or polyline was found."
         return None, message
 
-    csv_data = []
-
-    for image in images:
-
-        if image.getSizeT() > 1:
-            message += "%s ID: %s appears to be a time-lapse Image," \
-                " not a kymograph." % (image.getName(), image.getId())
-            continue
-
-        roi_service = conn.getRoiService()
-        result = roi_service.findByImage(image.getId(), None)
-
-        secs_per_pixel_y = image.getPixelSizeY()
-        microns_per_pixel_x = image.getPixelSizeX()
-        if secs_per_pixel_y and microns_per_pixel_x:
-            microns_per_sec = microns_per_pixel_x / secs_per_pixel_y
-        else:
-            microns_per_sec = None
-
-        # for each line or polyline, create a row in csv table: y(t), x,
-        # dy(dt), dx, x/t (line), x/t (average)
-        col_names = "\nt_start (pixels), x_start (pixels), t_end (pixels)," \
-            " x_end (pixels), dt (pixels), dx (pixels), x/t, speed(um/sec)," \
-            "avg x/t, avg speed(um/sec)"
-        table_data = ""
-        for roi in result.rois:
-            for s in roi.copyShapes():
-                if s is None:
-                    continue    # seems possible in some situations
-                if type(s) == omero.model.LineI:
-                    table_data += "\nLine ID: %s" % s.getId().getValue()
-                    x1 = s.getX1().getValue()
-                    x2 = s.getX2().getValue()
-                    y1 = s.getY1().getValue()
-                    y2 = s.getY2().getValue()
-                    dx = abs(x1-x2)
-                    dy = abs(y1-y2)
-                    dx_per_y = float(dx)/dy
-                    speed = ""
-                    if microns_per_sec:
-                        speed = dx_per_y * microns_per_sec
-                    table_data += "\n"
-                    table_data += ",".join(
-                        [str(x) for x in (y1, x1, y2, x2, dy, dx, dx_per_y,
-                                          speed)])
-
-                elif type(s) == omero.model.PolylineI:
-                    table_data += "\nPolyline ID: %s" % s.getId().getValue()
-                    v = s.getPoints().getValue()
-                    points = points_string_to_xy_list(v)
-                    x_start, y_start = points[0]
-                    for i in range(1, len(points)):
-                        x1, y1 = points[i-1]
-                        x2, y2 = points[i]
-                        dx = abs(x1-x2)
-                        dy = abs(y1-y2)
-                        dx_per_y = float(dx)/dy
-                        av_x_per_y = abs(float(x2-x_start)/(y2-y_start))
-                        speed = ""
-                        avg_speed = ""
-                        if microns_per_sec:
-                            speed = dx_per_y * microns_per_sec
-                            avg_speed = av_x_per_y * microns_per_sec
-                        table_data += "\n"
-                        table_data += ",".join(
-                            [str(x) for x in (y1, x1, y2, x2, dy, dx, dx_per_y,
-                                              speed, av_x_per_y, avg_speed)])
-
-        # write table data to csv...
-        if len(table_data) > 0:
-            table_string = "Image ID:, %s," % image.getId()
-            table_string += "Name:, %s" % image.getName()
-            table_string += "\nsecsPerPixelY: %s" % secs_per_pixel_y
-            table_string += '\nmicronsPerPixelX: %s' % microns_per_pixel_x
-            table_string += "\n"
-            table_string += col_names
-            table_string += table_data
-            csv_data.append(table_string)
-
     iids = [str(i.getId()) for i in images]
     to_link_csv = [i.getId() for i in images if i.canAnnotate()]
     csv_file_name = 'kymograph_velocities_%s.csv' % "-".join(iids)
+    segment_table = None
+    if script_params.get("Create_Table", True):
+        segment_table = SegmentTable(
+            conn, 'kymograph_velocities_%s' % "-".join(iids))
+
+    # Each image's section of the csv is written as it is made
     with open(csv_file_name, 'w') as csv_file:
-        csv_file.write("\n \n".join(csv_data))
+        first_section = True
+
+        for image in images:
+
+            if image.getSizeT() > 1:
+                message += "%s ID: %s appears to be a time-lapse Image," \
+                    " not a kymograph." % (image.getName(), image.getId())
+                continue
+
+            roi_service = conn.getRoiService()
+            result = roi_service.findByImage(image.getId(), None)
+
+            secs_per_pixel_y = image.getPixelSizeY()
+            microns_per_pixel_x = image.getPixelSizeX()
+            if secs_per_pixel_y and microns_per_pixel_x:
+                microns_per_sec = microns_per_pixel_x / secs_per_pixel_y
+            else:
+                microns_per_sec = None
+
+            # for each line or polyline, create a row in csv table: y(t), x,
+            # dy(dt), dx, x/t (line), x/t (average)
+            col_names = "\nt_start (pixels), x_start (pixels)," \
+                " t_end (pixels), x_end (pixels), dt (pixels), dx (pixels)," \
+                " x/t, speed(um/sec),avg x/t, avg speed(um/sec)"
+            table_data = []
+            for roi in result.rois:
+                for s in roi.copyShapes():
+                    if s is None:
+                        continue    # seems possible in some situations
+                    if type(s) == omero.model.LineI:
+                        shape_type = "Line"
+                        table_data.append("Line ID: %s"
+                                          % s.getId().getValue())
+                        xs = [s.getX1().getValue(), s.getX2().getValue()]
+                        ys = [s.getY1().getValue(), s.getY2().getValue()]
+                        segments = get_segments(xs, ys, microns_per_sec)
+                        table_data.extend(segments_to_csv_rows(
+                            segments, SEGMENT_COLUMNS[:8], microns_per_sec))
+
+                    elif type(s) == omero.model.PolylineI:
+                        shape_type = "Polyline"
+                        table_data.append("Polyline ID: %s"
+                                          % s.getId().getValue())
+                        v = s.getPoints().getValue()
+                        points = points_string_to_xy_array(v)
+                        segments = get_segments(points[:, 0], points[:, 1],
+                                                microns_per_sec)
+                        table_data.extend(segments_to_csv_rows(
+                            segments, SEGMENT_COLUMNS, microns_per_sec))
+                    else:
+                        continue
+                    if segment_table is not None:
+                        segment_table.add(
+                            image.getId(), roi.getId().getValue(),
+                            s.getId().getValue(), shape_type, segments)
+
+            # write table data to csv...
+            if len(table_data) > 0:
+                table_string = "Image ID:, %s," % image.getId()
+                table_string += "Name:, %s" % image.getName()
+                table_string += "\nsecsPerPixelY: %s" % secs_per_pixel_y
+                table_string += '\nmicronsPerPixelX: %s' % microns_per_pixel_x
+                table_string += "\n"
+                table_string += col_names
+                if not first_section:
+                    csv_file.write("\n \n")
+                csv_file.write(table_string)
+                csv_file.write("\n")
+                csv_file.write("\n".join(table_data))
+                first_section = False
 
     file_ann = conn.createFileAnnfromLocalFile(csv_file_name,
                                                mimetype="text/csv")
     fa_message = "Created Line Plot csv (Excel) file"
+    link_file_annotation(conn, to_link_csv, file_ann._obj)
+
+    if segment_table is not None:
+        table_ann = segment_table.close()
+        if table_ann is not None:
+            link_file_annotation(conn, to_link_csv, table_ann)
+            fa_message += " and OMERO.table"
 
-    links = []
     if len(to_link_csv) == 0:
         fa_message += " but could not attach to images."
-    for iid in to_link_csv:
-        link = ImageAnnotationLinkI()
-        link.parent = ImageI(iid, False)
-        link.child = file_ann._obj
-        links.append(link)
-    if len(links) > 0:
-        links = conn.getUpdateService().saveAndReturnArray(links)
 
     if file_ann:
         file_anns.append(file_ann)
@@ -212,6 +368,11 @@ of movement, saved as an Excel / CSV file.""",
             "IDs", optional=False, grouping="2",
             description="List of Image IDs to process.").ofType(rlong(0)),
 
+        scripts.Bool(
+            "Create_Table", grouping="3", default=True,
+            description="Also save the velocity of each segment as an"
+            " OMERO.table attached to the Images"),
+
         version="4.3.3",
         authors=["William Moore", "OME Team"],
         institutions=["University of Dundee"],
@@ -23,17 +23,200 @@
 
 
 import omero.scripts as scripts
-from omero.gateway import BlitzGateway, MapAnnotationWrapper,\
-    FileAnnotationWrapper
+from omero.gateway import BlitzGateway, FileAnnotationWrapper, ImageWrapper
 from omero.rtypes import rint, rlong, robject, rstring, unwrap
-from omero.grid import DoubleColumn, ImageColumn
-from omero.model import OriginalFileI
+from omero.grid import DoubleColumn, ImageColumn, LongColumn, RoiColumn, \
+    StringColumn
+from omero.model import OriginalFileI, RectangleI, EllipseI, LineI, \
+    PolygonI, PolylineI, PointI, MaskI, MapAnnotationI, ImageI, \
+    ImageAnnotationLinkI, NamedValue
+from omero.api import ShapeStats
+from omero.sys import ParametersI
 from omero.constants.namespaces import NSBULKANNOTATIONS
 
-from collections import defaultdict
+from array import array
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import csv
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
 
 DEFAULT_FILE_NAME = "roi_intensities_filtered_by_channel.csv"
 BATCH_ROI_EXPORT_NS = "omero.batch_roi_export.map_ann"
+# Namespace of cached rows for each Image, used by Incremental_Export
+BATCH_ROI_EXPORT_CACHE_NS = "omero.batch_roi_export.cache"
+SERVER_ENGINE = "Server"
+LOCAL_ENGINE = "Local"
+CSV_FORMAT = "CSV"
+PARQUET_FORMAT = "Parquet"
+# Maximum size of pixel data read at once for shapes with no Z or T
+STACK_CHUNK_BYTES = 256 * 1024 * 1024
+# numpy dtypes of OMERO pixels types that have different names
+PIXELS_DTYPES = {"float": "float32", "double": "float64"}
+# Number of shapes loaded at a time for each image
+SHAPE_PAGE_SIZE = 1000
+# Shape types that can be exported
+SHAPE_TYPES = ["Rectangle", "Ellipse", "Line", "Polyline", "Polygon",
+               "Point", "Mask", "Label"]
+# Maximum number of rows in each block of exported rows
+ROW_BLOCK_SIZE = 10000
+# Number of rows in each addData() call to the per-shape OMERO.table
+TABLE_CHUNK_SIZE = 10000
+# Minimum number of rows in each row group of a Parquet export
+PARQUET_ROW_GROUP_SIZE = 100000
+# Number of Key-Value annotations in each saveAndReturnArray() call
+ANNOTATION_CHUNK_SIZE = 500
+
+# Upper limits (ms) of the buckets of RPC latency histograms
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class Instrumentation(object):
+    """
+    Phase timings and RPC call stats for a run of the script.
+
+    Phases can be timed more than once, and from several threads, so their
+    times are summed. RPCs are recorded with a count, total time and a
+    histogram of latencies for each service method.
+    """
+
+    def __init__(self):
+        """Create empty stats."""
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clear all the stats."""
+        with self.lock:
+            self.phases = {}
+            self.rpcs = {}
+            self.rows = 0
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase of the script."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + seconds
+
+    @contextmanager
+    def timed_call(self, name):
+        """Time a remote call."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_rpc(name, time.perf_counter() - start)
+
+    def add_rpc(self, name, seconds):
+        """Record a remote call that took seconds."""
+        millis = seconds * 1000
+        bucket = len(LATENCY_BUCKETS)
+        for i, limit in enumerate(LATENCY_BUCKETS):
+            if millis <= limit:
+                bucket = i
+                break
+        with self.lock:
+            if name not in self.rpcs:
+                self.rpcs[name] = {
+                    "count": 0, "seconds": 0,
+                    "histogram": [0] * (len(LATENCY_BUCKETS) + 1)}
+            rpc = self.rpcs[name]
+            rpc["count"] += 1
+            rpc["seconds"] += seconds
+            rpc["histogram"][bucket] += 1
+
+    def add_rows(self, count):
+        """Record count exported rows."""
+        with self.lock:
+            self.rows += count
+
+    def get_rows_per_second(self):
+        """Get the rows exported per second of the export phase."""
+        seconds = self.phases.get("export", 0)
+        return self.rows / seconds if seconds > 0 else 0
+
+    def get_message(self):
+        """Summarise the stats for the script Message."""
+        phases = ", ".join("%s %.1f s" % (name, seconds)
+                           for name, seconds in self.phases.items())
+        rpcs = ", ".join(
+            "%s %s x %.1f ms" % (name, rpc["count"],
+                                 rpc["seconds"] * 1000 / rpc["count"])
+            for name, rpc in sorted(self.rpcs.items()))
+        return "Timings: %s (%.0f rows/s). RPCs: %s" % (
+            phases, self.get_rows_per_second(), rpcs)
+
+    def to_json(self):
+        """Get all the stats as a JSON string."""
+        labels = ["<= %s ms" % limit for limit in LATENCY_BUCKETS]
+        labels.append("> %s ms" % LATENCY_BUCKETS[-1])
+        rpcs = {}
+        for name, rpc in self.rpcs.items():
+            rpcs[name] = {
+                "count": rpc["count"],
+                "total_seconds": rpc["seconds"],
+                "mean_ms": rpc["seconds"] * 1000 / rpc["count"],
+                "histogram": dict(zip(labels, rpc["histogram"]))}
+        return json.dumps({"phase_seconds": self.phases,
+                           "rpcs": rpcs,
+                           "rows": self.rows,
+                           "rows_per_second": self.get_rows_per_second()},
+                          indent=2)
+
+
+class TimedService(object):
+    """Wrap a service proxy, recording every method call with instruments."""
+
+    def __init__(self, service, name):
+        """Wrap service, recording calls as name.method."""
+        self._service = service
+        self._name = name
+
+    def __getattr__(self, attr):
+        """Get attr from the service, timing calls if it is a method."""
+        method = getattr(self._service, attr)
+        if not callable(method):
+            return method
+
+        def timed_method(*args, **kwargs):
+            with instruments.timed_call("%s.%s" % (self._name, attr)):
+                return method(*args, **kwargs)
+        return timed_method
+
+
+# Stats for the current run
+instruments = Instrumentation()
+
+# Service proxies for each worker thread
+thread_services = threading.local()
+
+# A shape to export, from iter_shape_pages(). shape is the ShapeI, if loaded
+ExportShape = namedtuple("ExportShape", [
+    "image_id", "roi_id", "shape_id", "type", "text", "the_z", "the_t",
+    "the_c", "shape"])
+
+# Metadata of each Image, loaded up front by get_image_records()
+ImageRecord = namedtuple("ImageRecord", [
+    "id", "name", "size_x", "size_y", "size_z", "size_c", "size_t",
+    "channel_labels", "dataset_name", "project_id", "group_id", "wrapper"])
 
 
 def log(data):
@@ -41,12 +224,620 @@ def log(data):
     print(data)
 
 
+def get_image_record(conn, image):
+    """
+    Create an ImageRecord from an ImageI.
+
+    The image must be loaded with pixels, channels, logical channels and
+    parent dataset and project.
+    """
+    pixels = image.getPrimaryPixels()
+    channel_labels = []
+    for index, channel in enumerate(pixels.copyChannels()):
+        # Same as ImageWrapper.getChannelLabels()
+        lc = channel.getLogicalChannel()
+        label = unwrap(lc.getName())
+        if label is None:
+            emission_wave = lc.getEmissionWave()
+            if emission_wave is not None:
+                label = str(emission_wave.getValue())
+            else:
+                label = str(index)
+        channel_labels.append(label)
+
+    dataset_name = ""
+    project_id = None
+    for dataset_link in image.copyDatasetLinks():
+        dataset = dataset_link.parent
+        dataset_name = dataset.name.val
+        for project_link in dataset.copyProjectLinks():
+            project_id = project_link.parent.id.val
+            break
+        break
+
+    return ImageRecord(
+        id=image.id.val,
+        name=image.name.val,
+        size_x=pixels.sizeX.val,
+        size_y=pixels.sizeY.val,
+        size_z=pixels.sizeZ.val,
+        size_c=pixels.sizeC.val,
+        size_t=pixels.sizeT.val,
+        channel_labels=channel_labels,
+        dataset_name=dataset_name,
+        project_id=project_id,
+        group_id=image.details.group.id.val,
+        wrapper=ImageWrapper(conn, image))
+
+
+def get_image_records(conn, data_type, ids):
+    """
+    Load all the Images in the Projects, Datasets or Images with ids.
+
+    Images are loaded with the metadata needed for the export in a single
+    query for each 1000 ids, and returned as a list of ImageRecord, ordered
+    by Dataset name and Image name (or in the order of ids for Images).
+    """
+    query = ("select distinct i from Image i"
+             " join fetch i.pixels p"
+             " join fetch p.channels c"
+             " join fetch c.logicalChannel"
+             " left outer join fetch i.datasetLinks dl"
+             " left outer join fetch dl.parent d"
+             " left outer join fetch d.projectLinks pl"
+             " left outer join fetch pl.parent pr")
+    if data_type == "Project":
+        query += " where pr.id in (:ids)"
+    elif data_type == "Dataset":
+        query += " where d.id in (:ids)"
+    else:
+        query += " where i.id in (:ids)"
+
+    ctx = get_all_groups_context(conn)
+    records = []
+    for i in range(0, len(ids), 1000):
+        params = ParametersI()
+        params.addIds(ids[i:i + 1000])
+        for image in get_query_service(conn).findAllByQuery(query, params,
+                                                            ctx):
+            records.append(get_image_record(conn, image))
+
+    if data_type == "Image":
+        order = dict((image_id, i) for i, image_id in enumerate(ids))
+        records.sort(key=lambda r: order[r.id])
+    else:
+        records.sort(key=lambda r: (r.dataset_name, r.name))
+    return records
+
+
+def get_roi_service(conn):
+    """Get a RoiService proxy for the current thread."""
+    if not hasattr(thread_services, "roi_service"):
+        thread_services.roi_service = TimedService(
+            conn.c.sf.getRoiService(), "RoiService")
+    return thread_services.roi_service
+
+
+def get_query_service(conn):
+    """Get the QueryService, recording calls with instruments."""
+    return TimedService(conn.getQueryService(), "QueryService")
+
+
+def get_image_context(conn, image):
+    """Get a call context for the group that image is in."""
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(image.group_id)
+    return ctx
+
+
+def get_all_groups_context(conn):
+    """Get a call context for querying across all groups."""
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(-1)
+    return ctx
+
+
+def get_shape_stats(roi_service, shape_planes, ch_indexes, ctx=None):
+    """
+    Get ShapeStats for many shapes, with a single call per plane.
+
+    Shapes are grouped by (Z, T) so that all shapes on the same plane are
+    measured together. Shapes with no Z or T are not measured.
+
+    @param shape_planes:    List of (shape_id, z, t)
+    @param ch_indexes:      Channel indexes to measure
+    @return:                Dict of {(shape_id, z, t): ShapeStats}
+    """
+    ids_by_plane = defaultdict(list)
+    for shape_id, z, t in shape_planes:
+        if z is not None and t is not None:
+            ids_by_plane[(z, t)].append(shape_id)
+
+    stats_by_plane = {}
+    for (z, t), shape_ids in ids_by_plane.items():
+        # ShapeStats are returned in the same order as shape_ids
+        plane_stats = roi_service.getShapeStatsRestricted(
+            shape_ids, z, t, ch_indexes, ctx)
+        for shape_id, stats in zip(shape_ids, plane_stats):
+            stats_by_plane[(shape_id, z, t)] = stats
+    return stats_by_plane
+
+
+def points_string_to_coords(string):
+    """
+    Get the coordinates text from a points string, as "x,y x,y".
+
+    Handles "points[309,427, 366,503]" and "309,427 366,503" formats.
+    """
+    string = string.strip()
+    if string.startswith("points"):
+        start = string.find("[")
+        end = string.find("]", start)
+        if start < 0 or end < 0:
+            raise ValueError(
+                "Unrecognised ROI shape 'points' string: %s" % string)
+        string = string[start + 1:end]
+    return string.replace(", ", " ")
+
+
+def coords_to_xy_array(coords):
+    """Parse "x,y x,y" coordinates text into a (N, 2) float numpy array."""
+    values = np.fromstring(coords.replace(",", " "), sep=" ")
+    # Each point has one comma between x and y
+    if values.size != 2 * coords.count(","):
+        raise ValueError("Unrecognised ROI shape 'points' string: %s"
+                         % coords[:100])
+    return values.reshape(-1, 2)
+
+
+def points_string_to_xy_array(string):
+    """
+    Convert string to (N, 2) numpy array of x, y points.
+
+    Expects string in format generated from omero.model.ShapeI.getPoints()
+    e.g. "points[309,427, 366,503]" or "309,427 366,503" to
+    array([[309., 427.], [366., 503.]])
+    """
+    coords = points_string_to_coords(string)
+    if not coords:
+        raise ValueError("Unrecognised ROI shape 'points' string: %s" % string)
+    return coords_to_xy_array(coords)
+
+
+def get_shape_bbox(shape, size_x, size_y):
+    """
+    Get the bounding box (x, y, w, h) of shape, clipped to the image.
+
+    Returns None if the shape can't be measured locally or is outside the
+    image.
+    """
+    if isinstance(shape, (RectangleI, MaskI)):
+        x1, y1 = shape.x.val, shape.y.val
+        x2, y2 = x1 + shape.width.val - 1, y1 + shape.height.val - 1
+    elif isinstance(shape, EllipseI):
+        x1 = shape.x.val - shape.radiusX.val
+        y1 = shape.y.val - shape.radiusY.val
+        x2 = shape.x.val + shape.radiusX.val
+        y2 = shape.y.val + shape.radiusY.val
+    elif isinstance(shape, LineI):
+        x1, x2 = sorted([shape.x1.val, shape.x2.val])
+        y1, y2 = sorted([shape.y1.val, shape.y2.val])
+    elif isinstance(shape, (PolygonI, PolylineI)):
+        xy = points_string_to_xy_array(shape.points.val)
+        x1, y1 = xy.min(axis=0)
+        x2, y2 = xy.max(axis=0)
+    elif isinstance(shape, PointI):
+        # Same pixel as get_shape_mask()
+        x1, y1 = x2, y2 = round(shape.x.val), round(shape.y.val)
+    else:
+        return None
+    x1 = max(0, int(math.floor(x1)))
+    y1 = max(0, int(math.floor(y1)))
+    x2 = min(size_x, int(math.floor(x2)) + 1)
+    y2 = min(size_y, int(math.floor(y2)) + 1)
+    if x2 <= x1 or y2 <= y1:
+        return None
+    return x1, y1, x2 - x1, y2 - y1
+
+
+def get_line_mask(xy, x, y, w, h):
+    """Rasterize the line segments joining points xy into a boolean mask."""
+    mask = np.zeros((h, w), dtype=bool)
+    for (x1, y1), (x2, y2) in zip(xy[:-1], xy[1:]):
+        # sample at least once per pixel along the segment
+        count = int(math.ceil(max(abs(x2 - x1), abs(y2 - y1)))) + 1
+        xs = np.round(np.linspace(x1, x2, count)).astype(int) - x
+        ys = np.round(np.linspace(y1, y2, count)).astype(int) - y
+        inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        mask[ys[inside], xs[inside]] = True
+    return mask
+
+
+def get_polygon_mask(xy, xs, ys):
+    """Even-odd test of pixel coordinates xs, ys against polygon xy."""
+    mask = np.zeros(xs.shape, dtype=bool)
+    for (x1, y1), (x2, y2) in zip(xy, np.roll(xy, -1, axis=0)):
+        if y1 == y2:
+            continue
+        crosses = (y1 > ys) != (y2 > ys)
+        x_cross = x1 + (ys - y1) * (x2 - x1) / (y2 - y1)
+        mask ^= crosses & (xs < x_cross)
+    return mask
+
+
+def get_shape_mask(shape, x, y, w, h):
+    """Rasterize shape into a boolean mask of the (x, y, w, h) region."""
+    ys, xs = np.mgrid[y:y + h, x:x + w]
+    if isinstance(shape, RectangleI):
+        sx, sy = shape.x.val, shape.y.val
+        return ((xs >= sx) & (xs < sx + shape.width.val) &
+                (ys >= sy) & (ys < sy + shape.height.val))
+    if isinstance(shape, EllipseI):
+        rx = max(shape.radiusX.val, 0.5)
+        ry = max(shape.radiusY.val, 0.5)
+        return (((xs - shape.x.val) / rx) ** 2 +
+                ((ys - shape.y.val) / ry) ** 2) <= 1
+    if isinstance(shape, LineI):
+        xy = np.array([[shape.x1.val, shape.y1.val],
+                       [shape.x2.val, shape.y2.val]])
+        return get_line_mask(xy, x, y, w, h)
+    if isinstance(shape, PolylineI):
+        xy = points_string_to_xy_array(shape.points.val)
+        return get_line_mask(xy, x, y, w, h)
+    if isinstance(shape, PolygonI):
+        xy = points_string_to_xy_array(shape.points.val)
+        return get_polygon_mask(xy, xs, ys)
+    if isinstance(shape, PointI):
+        return ((xs == int(round(shape.x.val))) &
+                (ys == int(round(shape.y.val))))
+    if isinstance(shape, MaskI):
+        mx = int(math.floor(shape.x.val))
+        my = int(math.floor(shape.y.val))
+        mw = int(shape.width.val)
+        mh = int(shape.height.val)
+        bits = np.unpackbits(np.frombuffer(shape.getBytes(), dtype=np.uint8))
+        bits = bits[:mw * mh].reshape((mh, mw)).astype(bool)
+        mask = np.zeros((h, w), dtype=bool)
+        sub = bits[y - my:y - my + h, x - mx:x - mx + w]
+        mask[:sub.shape[0], :sub.shape[1]] = sub
+        return mask
+    raise ValueError("Can't rasterize shape: %s" % shape.__class__.__name__)
+
+
+def get_value_stats(values):
+    """
+    Get stats of pixel values, reduced over the last axis of values.
+
+    Returns dict of arrays of count, min, max, sum, mean and std_dev, or
+    None if there are no values, so that the shape is not measured.
+    """
+    count = values.shape[-1]
+    if count == 0:
+        return None
+    return {"count": np.full(values.shape[:-1], count, dtype=np.int64),
+            "min": values.min(axis=-1),
+            "max": values.max(axis=-1),
+            "sum": values.sum(axis=-1),
+            "mean": values.mean(axis=-1),
+            "std_dev": values.std(axis=-1)}
+
+
+def create_shape_stats(shape_id, ch_indexes, stats, index=()):
+    """Create ShapeStats from get_value_stats() at index, for each channel."""
+    return ShapeStats(shapeId=shape_id,
+                      channelIds=list(ch_indexes),
+                      pointsCount=stats["count"][(slice(None),) + index]
+                      .tolist(),
+                      min=stats["min"][(slice(None),) + index].tolist(),
+                      max=stats["max"][(slice(None),) + index].tolist(),
+                      sum=stats["sum"][(slice(None),) + index].tolist(),
+                      mean=stats["mean"][(slice(None),) + index].tolist(),
+                      stdDev=stats["std_dev"][(slice(None),) + index]
+                      .tolist())
+
+
+def values_to_shape_stats(shape_id, ch_indexes, values):
+    """
+    Create ShapeStats from array of pixel values (channels, points).
+
+    Returns None if there are no values.
+    """
+    stats = get_value_stats(values)
+    if stats is None:
+        return None
+    return create_shape_stats(shape_id, ch_indexes, stats)
+
+
+def get_local_shape_stats(image, shape_planes, ch_indexes):
+    """
+    Get ShapeStats for many shapes, measuring pixel data locally.
+
+    Shapes on each plane are grouped by nearby bboxes into regions, and
+    each region is read once for all channels, in the pixel type of the
+    image. Shapes are rasterized into boolean masks and only their masked
+    values are converted to float64, then measured with NumPy reductions
+    over every channel at once.
+    Shapes that can't be rasterized (e.g. Labels) are not measured.
+
+    @param shape_planes:    List of (shape, z, t)
+    @param ch_indexes:      Channel indexes to measure
+    @return:                Dict of {(shape_id, z, t): ShapeStats}
+    """
+    if len(ch_indexes) == 0:
+        return {}
+    size_x = image.size_x
+    size_y = image.size_y
+    shapes_by_plane = defaultdict(list)
+    for shape, z, t in shape_planes:
+        if z is None or t is None:
+            continue
+        bbox = get_shape_bbox(shape, size_x, size_y)
+        if bbox is not None:
+            shapes_by_plane[(z, t)].append((shape, bbox))
+
+    pixels = image.wrapper.getPrimaryPixels()
+    stats_by_plane = {}
+    for (z, t), plane_shapes in shapes_by_plane.items():
+        for tile, region_shapes in group_shapes_by_region(plane_shapes):
+            x, y = tile[0], tile[1]
+            zct_list = [(z, c, t, tile) for c in ch_indexes]
+            # 3D array of (channels, y, x)
+            with instruments.timed_call("RawPixelsStore.getTiles"):
+                data = np.array(list(pixels.getTiles(zct_list)))
+            for shape, (bx, by, bw, bh) in region_shapes:
+                mask = get_shape_mask(shape, bx, by, bw, bh)
+                region = data[:, by - y:by - y + bh, bx - x:bx - x + bw]
+                stats = values_to_shape_stats(
+                    shape.id.val, ch_indexes,
+                    region[:, mask].astype(np.float64))
+                if stats is not None:
+                    stats_by_plane[(shape.id.val, z, t)] = stats
+    return stats_by_plane
+
+
+def is_stack_shape(shape, all_planes):
+    """Return True if shape is measured on a stack of Z or T planes."""
+    return all_planes and (shape.the_z is None or shape.the_t is None)
+
+
+def get_union_bbox(bboxes):
+    """Get the region (x, y, w, h) covering all the bboxes."""
+    x = min(bbox[0] for bbox in bboxes)
+    y = min(bbox[1] for bbox in bboxes)
+    x2 = max(bbox[0] + bbox[2] for bbox in bboxes)
+    y2 = max(bbox[1] + bbox[3] for bbox in bboxes)
+    return x, y, x2 - x, y2 - y
+
+
+def group_shapes_by_region(shape_bboxes):
+    """
+    Group shapes with nearby bboxes into regions that are read together.
+
+    A shape is added to a region if the union of the two is no bigger than
+    the region and the shape's bbox, so shapes far apart are read as
+    separate regions instead of one region covering them all.
+
+    @param shape_bboxes:    List of (shape, bbox)
+    @return:                List of (region bbox, list of (shape, bbox))
+    """
+    regions = []
+    shape_bboxes = sorted(shape_bboxes, key=lambda sb: (sb[1][1], sb[1][0]))
+    for shape, bbox in shape_bboxes:
+        for region in regions:
+            union = get_union_bbox([region[0], bbox])
+            if (union[2] * union[3] <=
+                    region[0][2] * region[0][3] + bbox[2] * bbox[3]):
+                region[0] = union
+                region[1].append((shape, bbox))
+                break
+        else:
+            regions.append([bbox, [(shape, bbox)]])
+    return regions
+
+
+def get_pixel_bytes(image):
+    """Get the number of bytes of each pixel of image."""
+    pixels_type = image.wrapper.getPixelsType()
+    if pixels_type == "bit":
+        return 1
+    return np.dtype(PIXELS_DTYPES.get(pixels_type, pixels_type)).itemsize
+
+
+def get_local_stack_stats(image, shapes, ch_indexes):
+    """
+    Get ShapeStats for shapes with no Z or T, on every Z and T plane.
+
+    Shapes are grouped by the Z and T planes they are on, and then by
+    nearby bboxes into regions. Each region is read for the whole stack
+    with one getTiles() call per chunk of Z and T planes, of up to
+    STACK_CHUNK_BYTES of all channels, in the pixel type of the image.
+    Only the masked values of each shape are converted to float64, and
+    stats for every plane of a chunk are computed in one pass over them.
+
+    @param shapes:          List of ExportShape, with shape loaded
+    @param ch_indexes:      Channel indexes to measure
+    @return:                Dict of {(shape_id, z, t): ShapeStats}
+    """
+    if len(ch_indexes) == 0:
+        return {}
+    shapes_by_stack = defaultdict(list)
+    for shape in shapes:
+        bbox = get_shape_bbox(shape.shape, image.size_x, image.size_y)
+        if bbox is None:
+            continue
+        z_indexes = [shape.the_z]
+        if shape.the_z is None:
+            z_indexes = range(image.size_z)
+        t_indexes = [shape.the_t]
+        if shape.the_t is None:
+            t_indexes = range(image.size_t)
+        shapes_by_stack[(tuple(z_indexes), tuple(t_indexes))].append(
+            (shape.shape, bbox))
+
+    pixels = image.wrapper.getPrimaryPixels()
+    pixel_bytes = get_pixel_bytes(image)
+    stats_by_plane = {}
+    for (z_indexes, t_indexes), stack_shapes in shapes_by_stack.items():
+        planes = [(z, t) for t in t_indexes for z in z_indexes]
+        for tile, region_shapes in group_shapes_by_region(stack_shapes):
+            x, y, w, h = tile
+            masks = [(shape, bbox, get_shape_mask(shape, *bbox))
+                     for shape, bbox in region_shapes]
+
+            # Read as many planes at once as fit in STACK_CHUNK_BYTES
+            plane_bytes = w * h * len(ch_indexes) * pixel_bytes
+            chunk_size = max(1, STACK_CHUNK_BYTES // plane_bytes)
+            for i in range(0, len(planes), chunk_size):
+                chunk = planes[i:i + chunk_size]
+                zct_list = [(z, c, t, tile) for c in ch_indexes
+                            for z, t in chunk]
+                with instruments.timed_call("RawPixelsStore.getTiles"):
+                    data = np.array(list(pixels.getTiles(zct_list)))
+                data = data.reshape((len(ch_indexes), len(chunk), h, w))
+                for shape, (bx, by, bw, bh), mask in masks:
+                    region = data[..., by - y:by - y + bh, bx - x:bx - x + bw]
+                    # Stats for every plane, as arrays of (C, planes)
+                    stats = get_value_stats(
+                        region[..., mask].astype(np.float64))
+                    if stats is None:
+                        continue
+                    for pi, (z, t) in enumerate(chunk):
+                        stats_by_plane[(shape.id.val, z, t)] = \
+                            create_shape_stats(shape.id.val, ch_indexes,
+                                               stats, (pi,))
+    return stats_by_plane
+
+
+def get_shape_type(shape_class):
+    """
+    Get the lower case type of a shape from the value of s.class in HQL.
+
+    e.g. "rectangle" from "ome.model.roi.Rectangle" or "/shape/rectangle/"
+    """
+    return re.split("[./]", str(shape_class).strip("/"))[-1].lower()
+
+
+def iter_shape_pages(conn, image_ids, the_c, shape_types, load_shapes,
+                     ctx, page_size=SHAPE_PAGE_SIZE):
+    """
+    Yield pages of the shapes on images that are on channel the_c.
+
+    Shapes of all types are queried together, filtered by channel and, if
+    not all SHAPE_TYPES are chosen, by type in the query. They are loaded
+    in pages of page_size, using the last shape ID of each page to get the
+    next. Unless load_shapes is True, only the fields needed for the
+    export are loaded, not the shapes themselves.
+    Yields lists of ExportShape, ordered by shape ID.
+    """
+    if len(shape_types) == 0:
+        return
+    fields = ("r.image.id, r.id, s.id, s.class, s.textValue, s.theZ, s.theT,"
+              " s.theC")
+    if load_shapes:
+        fields += ", s"
+    query = ("select %s from Shape s join s.roi r"
+             " where r.image.id in (:ids) and s.theC = :c" % fields)
+    if set(shape_types) != set(SHAPE_TYPES):
+        query += " and s.class in (%s)" % ", ".join(shape_types)
+    query += " and s.id > :last order by s.id"
+    last_id = -1
+    while True:
+        params = ParametersI()
+        params.addIds(image_ids)
+        params.add("c", rint(the_c))
+        params.add("last", rlong(last_id))
+        params.page(0, page_size)
+        rows = get_query_service(conn).projection(query, params, ctx)
+        if len(rows) == 0:
+            break
+        shapes = []
+        for row in rows:
+            values = unwrap(row[:8])
+            shape = row[8].val if load_shapes else None
+            shapes.append(ExportShape(values[0], values[1], values[2],
+                                      get_shape_type(values[3]),
+                                      *values[4:], shape=shape))
+        yield shapes
+        if len(rows) < page_size:
+            break
+        last_id = shapes[-1].shape_id
+
+
+def get_shape_types(script_params):
+    """Get the SHAPE_TYPES chosen with Shape_Types, or all if none chosen."""
+    chosen = [t.lower() for t in script_params.get("Shape_Types") or []]
+    if len(chosen) == 0:
+        return SHAPE_TYPES
+    return [t for t in SHAPE_TYPES if t.lower() in chosen]
+
+
+def get_shape_planes(shapes, image, all_planes):
+    """
+    Get the planes to measure each ExportShape on.
+
+    Returns a list of (shape, z, t).
+    """
+    shape_planes = []
+    for shape in shapes:
+        # If shape has no Z or T, we may go through all planes...
+        z_indexes = [shape.the_z]
+        if shape.the_z is None and all_planes:
+            z_indexes = range(image.size_z)
+        # Same for T...
+        t_indexes = [shape.the_t]
+        if shape.the_t is None and all_planes:
+            t_indexes = range(image.size_t)
+        for z in z_indexes:
+            for t in t_indexes:
+                shape_planes.append((shape, z, t))
+    return shape_planes
+
+
+def get_stats_by_plane(roi_service, image, shapes, shape_planes, ch_indexes,
+                       all_planes, local_engine, ctx):
+    """
+    Get ShapeStats for a page of shapes, on the server or locally.
+
+    Returns dict of {(shape_id, z, t): ShapeStats}
+    """
+    if local_engine:
+        # Shapes with no Z or T are measured on the whole stack at once
+        stats_by_plane = get_local_shape_stats(
+            image, [(s.shape, z, t) for s, z, t in shape_planes
+                    if not is_stack_shape(s, all_planes)],
+            ch_indexes)
+        stats_by_plane.update(get_local_stack_stats(
+            image, [s for s in shapes if is_stack_shape(s, all_planes)],
+            ch_indexes))
+        return stats_by_plane
+    return get_shape_stats(
+        roi_service, [(s.shape_id, z, t) for s, z, t in shape_planes],
+        ch_indexes, ctx)
+
+
+def get_filter_channel(image):
+    """Get the index of the channel that shapes are filtered by."""
+    filter_ch = 0
+
+    # For idr0021 use-case, we want to pick filter_channel dynamically...
+    # First channel where channel name matches Dataset name.
+    for c, name in enumerate(image.channel_labels):
+        if name in image.dataset_name:
+            filter_ch = c
+    return filter_ch
+
+
 def get_export_data(conn, script_params, image):
-    """Get pixel data for shapes on image and returns list of dicts."""
+    """
+    Get pixel data for shapes on image.
+
+    Yields ExportColumns blocks of up to ROW_BLOCK_SIZE rows.
+    """
     log("Image ID %s..." % image.id)
-    roi_service = conn.getRoiService()
+    roi_service = get_roi_service(conn)
+    ctx = get_image_context(conn, image)
     all_planes = script_params["Export_All_Planes"]
-    size_c = image.getSizeC()
+    size_c = image.size_c
     # Channels index
     channels = script_params.get("Intensity_For_Channels", [1])
     ch_indexes = []
@@ -57,75 +848,227 @@ def get_export_data(conn, script_params, image):
             # User input is 1-based
             ch_indexes.append(ch - 1)
 
-    filter_ch = 0
-
-    # For idr0021 use-case, we want to pick filter_channel dynamically...
-    # First channel where channel name matches Dataset name.
-    dataset_name = image.getParent().name
-    for c, name in enumerate(image.getChannelLabels()):
-        if name in dataset_name:
-            filter_ch = c
-
-    ch_names = image.getChannelLabels()
-
-    ch_names = [ch_name.replace(",", ".") for ch_name in ch_names]
-    image_name = image.getName().replace(",", ".")
+    filter_ch = get_filter_channel(image)
+    ch_names = image.channel_labels
+    image_name = image.name
 
-    result = roi_service.findByImage(image.getId(), None)
-
-    export_data = []
     log("Filter_Shapes_By_Channel: %s" % filter_ch)
-    for roi in result.rois:
-        for shape in roi.copyShapes():
-            if filter_ch is not None and filter_ch != unwrap(shape.theC):
-                log("%s != %s" % (filter_ch, unwrap(shape.theC)))
-                continue
-            label = unwrap(shape.getTextValue())
-            # wrap label in double quotes in case it contains comma
-            label = "" if label is None else '"%s"' % label.replace(",", ".")
-            shape_type = shape.__class__.__name__.rstrip('I').lower()
-            # If shape has no Z or T, we may go through all planes...
-            the_z = unwrap(shape.theZ)
-            z_indexes = [the_z]
-            if the_z is None and all_planes:
-                z_indexes = range(image.getSizeZ())
-            # Same for T...
-            the_t = unwrap(shape.theT)
-            t_indexes = [the_t]
-            if the_t is None and all_planes:
-                t_indexes = range(image.getSizeT())
+    shape_types = get_shape_types(script_params)
+    local_engine = script_params.get("Intensity_Engine") == LOCAL_ENGINE
+    block = ExportColumns(COLUMN_NAMES, COLUMN_TYPES)
+    # Only one page of shapes is loaded at a time
+    for shapes in iter_shape_pages(conn, [image.id], filter_ch, shape_types,
+                                   local_engine, ctx):
+        # First, find which planes we need stats for, for each shape...
+        shape_planes = get_shape_planes(shapes, image, all_planes)
+
+        # ...then get intensities for all shapes on each plane together
+        with instruments.phase("stats"):
+            stats_by_plane = get_stats_by_plane(
+                roi_service, image, shapes, shape_planes, ch_indexes,
+                all_planes, local_engine, ctx)
+
+        for shape, z, t in shape_planes:
+            label = "" if shape.text is None else shape.text
             # Get the C shape is on.
             # This is independent of ch_indexes we're getting intensities for
-            the_c = unwrap(shape.theC)
-
-            # get pixel intensities
-            for z in z_indexes:
-                for t in t_indexes:
-                    if z is None or t is None:
-                        stats = None
-                    else:
-                        stats = roi_service.getShapeStatsRestricted(
-                            [shape.id.val], z, t, ch_indexes)
-                    for c, ch_index in enumerate(ch_indexes):
-                        export_data.append({
-                            "image_id": image.getId(),
-                            "image_name": '"%s"' % image_name,
-                            "roi_id": roi.id.val,
-                            "shape_id": shape.id.val,
-                            "type": shape_type,
-                            "text": label,
-                            "z": z + 1 if z is not None else "",
-                            "t": t + 1 if t is not None else "",
-                            "c": the_c + 1 if the_c is not None else "",
-                            "points": stats[0].pointsCount[c] if stats else "",
-                            "intensity_for_channel": ch_names[ch_index],
-                            "min": stats[0].min[c] if stats else "",
-                            "max": stats[0].max[c] if stats else "",
-                            "sum": stats[0].sum[c] if stats else "",
-                            "mean": stats[0].mean[c] if stats else "",
-                            "std_dev": stats[0].stdDev[c] if stats else ""
-                        })
-    return export_data
+            the_c = shape.the_c
+            stats = stats_by_plane.get((shape.shape_id, z, t))
+            for c, ch_index in enumerate(ch_indexes):
+                block.append({
+                    "image_id": image.id,
+                    "image_name": image_name,
+                    "roi_id": shape.roi_id,
+                    "shape_id": shape.shape_id,
+                    "type": shape.type,
+                    "text": label,
+                    "z": z + 1 if z is not None else "",
+                    "t": t + 1 if t is not None else "",
+                    "c": the_c + 1 if the_c is not None else "",
+                    "points": stats.pointsCount[c] if stats else "",
+                    "intensity_for_channel": ch_names[ch_index],
+                    "min": stats.min[c] if stats else "",
+                    "max": stats.max[c] if stats else "",
+                    "sum": stats.sum[c] if stats else "",
+                    "mean": stats.mean[c] if stats else "",
+                    "std_dev": stats.stdDev[c] if stats else ""
+                })
+            if len(block) >= ROW_BLOCK_SIZE:
+                yield block
+                block = ExportColumns(COLUMN_NAMES, COLUMN_TYPES)
+    if len(block) > 0:
+        yield block
+
+
+def get_roi_fingerprints(conn, images, script_params):
+    """
+    Get a fingerprint of the ROIs on each image and the export parameters.
+
+    The fingerprint changes if any shape is added, deleted or edited, if
+    parameters that change the exported rows are different, or if the
+    Image, channel or Dataset names that choose the shapes or are written
+    in the rows change.
+    Returns dict of {image_id: fingerprint}.
+    """
+    params_key = repr([script_params.get("Intensity_For_Channels"),
+                       script_params.get("Export_All_Planes"),
+                       script_params.get("Intensity_Engine"),
+                       get_shape_types(script_params)])
+    shapes = defaultdict(list)
+    query = ("select r.image.id, s.id, s.details.updateEvent.id"
+             " from Shape s join s.roi r where r.image.id in (:ids)"
+             " order by s.id")
+    image_ids = [image.id for image in images]
+    ctx = get_all_groups_context(conn)
+    for i in range(0, len(image_ids), 1000):
+        params = ParametersI()
+        params.addIds(image_ids[i:i + 1000])
+        for row in get_query_service(conn).projection(query, params, ctx):
+            image_id, shape_id, event_id = unwrap(row)
+            shapes[image_id].append((shape_id, event_id))
+
+    fingerprints = {}
+    for image in images:
+        key = params_key + repr([get_filter_channel(image), image.name,
+                                 image.channel_labels, shapes[image.id]])
+        fingerprints[image.id] = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return fingerprints
+
+
+def get_cached_exports(conn, images):
+    """
+    Get the FileAnnotations of cached rows for each image.
+
+    The description of each FileAnnotation is the fingerprint of the ROIs
+    it was exported from. Returns dict of {image_id: FileAnnotationI}.
+    """
+    query = ("select l from ImageAnnotationLink l join fetch l.child a"
+             " join fetch a.file where l.parent.id in (:ids) and a.ns = :ns")
+    image_ids = [image.id for image in images]
+    ctx = get_all_groups_context(conn)
+    cached = {}
+    for i in range(0, len(image_ids), 1000):
+        params = ParametersI()
+        params.addIds(image_ids[i:i + 1000])
+        params.addString("ns", BATCH_ROI_EXPORT_CACHE_NS)
+        for link in get_query_service(conn).findAllByQuery(query, params,
+                                                           ctx):
+            cached[link.parent.id.val] = link.child
+    return cached
+
+
+def parse_csv_value(value, col_type):
+    """Convert a value read from CSV to the type of its column."""
+    if col_type == STRING or value == "":
+        return value
+    if col_type == "q":
+        return int(value)
+    return float(value)
+
+
+def read_cached_export_data(conn, image, cache_ann):
+    """Read cached rows for image, yielding ExportColumns blocks."""
+    file_name = "batch_roi_export_cache_%s.csv" % image.id
+    conn.c.download(cache_ann.file, file_name)
+    with open(file_name, "r", newline="") as csv_file:
+        reader = csv.reader(csv_file)
+        col_names = next(reader)
+        col_types = [COLUMN_TYPES[name] for name in col_names]
+        block = ExportColumns(COLUMN_NAMES, COLUMN_TYPES)
+        for values in reader:
+            block.append(dict(
+                (name, parse_csv_value(value, col_type))
+                for name, col_type, value in zip(col_names, col_types,
+                                                 values)))
+            if len(block) >= ROW_BLOCK_SIZE:
+                yield block
+                block = ExportColumns(COLUMN_NAMES, COLUMN_TYPES)
+        if len(block) > 0:
+            yield block
+
+
+def get_incremental_export_data(conn, script_params, image, fingerprint,
+                                cache_ann):
+    """
+    Get export data for image, re-using cached rows if ROIs are unchanged.
+
+    Otherwise rows are exported and saved as a new cache, attached to the
+    image with the ROI fingerprint, replacing any previous cache.
+    Yields ExportColumns blocks.
+    """
+    if cache_ann is not None and unwrap(cache_ann.description) == fingerprint:
+        log("Image ID %s ROIs unchanged. Using cached rows" % image.id)
+        for block in read_cached_export_data(conn, image, cache_ann):
+            yield block
+        return
+
+    file_name = "batch_roi_export_cache_%s.csv" % image.id
+    with open(file_name, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(COLUMN_NAMES)
+        for block in get_export_data(conn, script_params, image):
+            writer.writerows(block.iter_rows(COLUMN_NAMES))
+            yield block
+
+    if not image.wrapper.canAnnotate():
+        return
+    file_ann = conn.createFileAnnfromLocalFile(
+        file_name, mimetype="text/csv", ns=BATCH_ROI_EXPORT_CACHE_NS,
+        desc=fingerprint)
+    image.wrapper.linkAnnotation(file_ann)
+    if cache_ann is not None:
+        conn.deleteObjects("Annotation", [cache_ann.id.val], wait=True)
+
+
+def get_image_export_data(conn, script_params, image, cache=None):
+    """
+    Get export data for image, yielding ExportColumns blocks.
+
+    cache is None, or a tuple of (fingerprints, cached_exports) to use for
+    an incremental export.
+    """
+    if cache is None:
+        return get_export_data(conn, script_params, image)
+    fingerprints, cached_exports = cache
+    return get_incremental_export_data(
+        conn, script_params, image, fingerprints[image.id],
+        cached_exports.get(image.id))
+
+
+def iter_export_data(conn, script_params, images):
+    """
+    Yield the ExportColumns blocks for each image, in the same order as
+    images.
+
+    If Max_Workers is more than 1, images are processed concurrently by a
+    bounded pool of threads, each with its own service proxies.
+    If Incremental_Export, rows are re-used for images whose ROIs haven't
+    changed since the last export.
+    """
+    cache = None
+    if script_params.get("Incremental_Export"):
+        cache = (get_roi_fingerprints(conn, images, script_params),
+                 get_cached_exports(conn, images))
+
+    max_workers = script_params.get("Max_Workers") or 1
+    if max_workers <= 1:
+        for image in images:
+            yield get_image_export_data(conn, script_params, image, cache)
+        return
+
+    def get_image_blocks(image):
+        return list(get_image_export_data(conn, script_params, image,
+                                          cache))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Don't queue up more images than we need to keep workers busy
+        pending = deque()
+        for image in images:
+            pending.append(executor.submit(get_image_blocks, image))
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
 
 
 COLUMN_NAMES = ["image_id",
@@ -154,6 +1097,114 @@ SUMMARY_COL_NAMES = ["filter_shapes_by_channel",
                      "max_points",
                      "mean_points"]
 
+# Column types are array typecodes, or STRING for dictionary-encoded strings
+STRING = "s"
+COLUMN_TYPES = {"image_id": "q",
+                "image_name": STRING,
+                "roi_id": "q",
+                "shape_id": "q",
+                "type": STRING,
+                "text": STRING,
+                "z": "q",
+                "t": "q",
+                "c": "q",
+                "points": "q",
+                "intensity_for_channel": STRING,
+                "min": "d",
+                "max": "d",
+                "sum": "d",
+                "mean": "d",
+                "std_dev": "d"}
+SUMMARY_COL_TYPES = {"filter_shapes_by_channel": "q",
+                     "shape_count": "q",
+                     "min_intensity": "d",
+                     "max_intensity": "d",
+                     "mean_intensity": "d",
+                     "min_points": "q",
+                     "max_points": "q",
+                     "mean_points": "d"}
+
+# Size of String columns in the per-shape OMERO.table
+SHAPE_TABLE_STRING_SIZES = {"image_name": 256,
+                            "type": 16,
+                            "text": 256,
+                            "intensity_for_channel": 64}
+
+# Missing values are stored as -1 for integers and NaN for floats
+MISSING_VALUES = {"q": -1, "d": float("nan")}
+NUMPY_DTYPES = {"q": np.int64, "d": np.float64, STRING: np.int32}
+
+
+class ExportColumns(object):
+    """
+    Columnar store of exported rows.
+
+    Numeric columns are typed arrays and string columns are dictionary
+    encoded, with an array of codes into a list of distinct values.
+    Missing values ("" or None) are stored as MISSING_VALUES.
+    """
+
+    def __init__(self, col_names, col_types):
+        """Create an empty store with the given columns."""
+        self.col_names = col_names
+        self.col_types = col_types
+        self.columns = {}
+        self.strings = {}
+        for name in col_names:
+            if col_types[name] == STRING:
+                self.columns[name] = array("i")
+                self.strings[name] = ([], {})
+            else:
+                self.columns[name] = array(col_types[name])
+
+    def __len__(self):
+        """Get the number of rows."""
+        return len(self.columns[self.col_names[0]])
+
+    def append(self, row):
+        """Append a row, from a dict of {col_name: value}."""
+        for name in self.col_names:
+            value = row[name]
+            col_type = self.col_types[name]
+            if col_type == STRING:
+                values, codes = self.strings[name]
+                code = codes.get(value)
+                if code is None:
+                    code = codes[value] = len(values)
+                    values.append(value)
+                value = code
+            elif value is None or value == "":
+                value = MISSING_VALUES[col_type]
+            self.columns[name].append(value)
+
+    def get_array(self, name):
+        """Get a numpy view of a column (string columns give codes)."""
+        col_type = self.col_types[name]
+        return np.frombuffer(self.columns[name], dtype=NUMPY_DTYPES[col_type])
+
+    def get_float_array(self, name):
+        """Get a numeric column as floats, with NaN for missing values."""
+        values = self.get_array(name).astype(np.float64)
+        if self.col_types[name] == "q":
+            values[values == MISSING_VALUES["q"]] = np.nan
+        return values
+
+    def get_column(self, name):
+        """Get a column as a list, with "" for missing values."""
+        col_type = self.col_types[name]
+        if col_type == STRING:
+            values = self.strings[name][0]
+            return [values[code] for code in self.columns[name]]
+        if col_type == "d":
+            return ["" if math.isnan(v) else v for v in self.columns[name]]
+        missing = MISSING_VALUES[col_type]
+        return ["" if v == missing else v for v in self.columns[name]]
+
+    def iter_rows(self, col_names):
+        """Yield each row as a list of values for col_names."""
+        columns = [self.get_column(name) for name in col_names]
+        return zip(*columns)
+
 
 def link_table(conn, table, project):
     """Create FileAnnotation for OMERO.table and links to Project."""
@@ -165,71 +1216,282 @@ def link_table(conn, table, project):
     project.linkAnnotation(file_ann)
 
 
-def write_csv(conn, export_data, file_name, col_names):
-    """Write the list of data to a CSV file and create a file annotation."""
+def write_csv(conn, blocks, file_name, col_names):
+    """
+    Write ExportColumns blocks to a CSV file and create a file annotation.
+
+    Blocks are written as they are produced, so blocks can be a generator.
+    """
     if len(file_name) == 0:
         file_name = DEFAULT_FILE_NAME
     if not file_name.endswith(".csv"):
         file_name += ".csv"
 
-    csv_rows = [",".join(col_names)]
-    for row in export_data:
-        cells = [str(row.get(name)) for name in col_names]
-        csv_rows.append(",".join(cells))
-
-    with open(file_name, 'w') as csv_file:
-        csv_file.write("\n".join(csv_rows))
+    with open(file_name, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(col_names)
+        for block in blocks:
+            with instruments.phase("write_file"):
+                writer.writerows(block.iter_rows(col_names))
+
+    with instruments.phase("upload"):
+        return conn.createFileAnnfromLocalFile(file_name,
+                                               mimetype="text/csv")
+
+
+def block_to_record_batch(block, col_names):
+    """
+    Convert an ExportColumns block to a pyarrow RecordBatch.
+
+    String columns are dictionary-encoded and missing values are null.
+    """
+    arrays = []
+    for name in col_names:
+        col_type = block.col_types[name]
+        values = block.get_array(name)
+        if col_type == STRING:
+            arrays.append(pyarrow.DictionaryArray.from_arrays(
+                pyarrow.array(values),
+                pyarrow.array(block.strings[name][0], type=pyarrow.string())))
+        elif col_type == "q":
+            arrays.append(pyarrow.array(
+                values, mask=values == MISSING_VALUES["q"]))
+        else:
+            arrays.append(pyarrow.array(values, mask=np.isnan(values)))
+    return pyarrow.RecordBatch.from_arrays(arrays, names=col_names)
 
-    return conn.createFileAnnfromLocalFile(file_name, mimetype="text/csv")
 
+def write_parquet(conn, blocks, file_name, col_names):
+    """
+    Write ExportColumns blocks to a Parquet file and create a file annotation.
 
-def get_summary_data_for_image(conn, image, export_data, script_params):
-    """Summarise ROIs as dict for this Image."""
-    # get all ROI data for this image
+    Blocks are written as they are produced, in row groups of at least
+    PARQUET_ROW_GROUP_SIZE rows (or the rows of all remaining images).
+    """
+    if len(file_name) == 0:
+        file_name = DEFAULT_FILE_NAME
+    if file_name.endswith(".csv"):
+        file_name = file_name[:-len(".csv")]
+    if not file_name.endswith(".parquet"):
+        file_name += ".parquet"
+
+    writer = None
+    batches = []
+    row_count = 0
+    for block in blocks:
+        with instruments.phase("write_file"):
+            batches.append(block_to_record_batch(block, col_names))
+            row_count += len(block)
+            if row_count >= PARQUET_ROW_GROUP_SIZE:
+                table = pyarrow.Table.from_batches(batches)
+                if writer is None:
+                    writer = pq.ParquetWriter(file_name, table.schema)
+                writer.write_table(table, row_group_size=row_count)
+                batches = []
+                row_count = 0
+    with instruments.phase("write_file"):
+        if len(batches) > 0:
+            table = pyarrow.Table.from_batches(batches)
+            if writer is None:
+                writer = pq.ParquetWriter(file_name, table.schema)
+            writer.write_table(table, row_group_size=row_count)
+        if writer is None:
+            # No rows exported. Write an empty file with the right columns
+            empty = ExportColumns(col_names, COLUMN_TYPES)
+            table = pyarrow.Table.from_batches([
+                block_to_record_batch(empty, col_names)])
+            writer = pq.ParquetWriter(file_name, table.schema)
+        writer.close()
+
+    with instruments.phase("upload"):
+        return conn.createFileAnnfromLocalFile(
+            file_name, mimetype="application/vnd.apache.parquet")
+
+
+def get_shape_table_columns():
+    """Create empty columns for the per-shape OMERO.table."""
+    columns = []
+    for name in COLUMN_NAMES:
+        col_type = COLUMN_TYPES[name]
+        if name == "image_id":
+            columns.append(ImageColumn("Image", "", []))
+        elif name == "roi_id":
+            columns.append(RoiColumn("Roi", "", []))
+        elif col_type == STRING:
+            size = SHAPE_TABLE_STRING_SIZES[name]
+            columns.append(StringColumn(name, "", size, []))
+        elif col_type == "q":
+            columns.append(LongColumn(name, "", []))
+        else:
+            columns.append(DoubleColumn(name, "", []))
+    return columns
+
+
+def get_table_values(block, name):
+    """Get the values of a column in block, for an OMERO.table column."""
+    if COLUMN_TYPES[name] != STRING:
+        # Missing values are -1 for Long columns and NaN for Double columns
+        return block.get_array(name).tolist()
+    # Truncate strings to fit the column
+    size = SHAPE_TABLE_STRING_SIZES[name]
+    values = [v.encode("utf-8")[:size].decode("utf-8", "ignore")
+              for v in block.strings[name][0]]
+    return [values[code] for code in block.columns[name]]
+
+
+class ShapeTableWriter(object):
+    """
+    Write exported rows to a per-shape OMERO.table.
+
+    Rows are appended in chunks of chunk_size rows as blocks are added, so
+    the whole export is never held in memory.
+    """
+
+    def __init__(self, conn, table_name, chunk_size=TABLE_CHUNK_SIZE):
+        """Create and initialize the table."""
+        resources = conn.c.sf.sharedResources()
+        repository_id = resources.repositories().descriptions[0].getId()\
+            .getValue()
+        self.table = TimedService(
+            resources.newTable(repository_id, table_name), "Table")
+        self.table.initialize(get_shape_table_columns())
+        self.chunk_size = chunk_size
+        # values waiting to be added, for each column
+        self.pending = [[] for name in COLUMN_NAMES]
+        self.row_count = 0
+
+    def add(self, block):
+        """Add an ExportColumns block, appending any complete chunks."""
+        for values, name in zip(self.pending, COLUMN_NAMES):
+            values.extend(get_table_values(block, name))
+        while len(self.pending[0]) >= self.chunk_size:
+            self.add_chunk(self.chunk_size)
+
+    def add_blocks(self, blocks):
+        """Add each block to the table as it passes through."""
+        for block in blocks:
+            with instruments.phase("shape_table"):
+                self.add(block)
+            yield block
+
+    def add_chunk(self, size):
+        """Append the first size pending rows to the table."""
+        columns = get_shape_table_columns()
+        for column, values in zip(columns, self.pending):
+            column.values = values[:size]
+            del values[:size]
+        self.table.addData(columns)
+        self.row_count += size
+
+    def close(self):
+        """Append any remaining rows and close the table."""
+        if len(self.pending[0]) > 0:
+            self.add_chunk(len(self.pending[0]))
+        self.table.close()
+        return self.table
+
+
+def get_summary_filter_channel(image, script_params):
+    """Get the 1-based filter channel to report in the Image summary."""
     filter_ch = script_params.get('Filter_Shapes_By_Channel', '')
 
     # For idr0021 use-case, we want to pick filter_channel dynamically...
     # First channel where channel name matches Dataset name.
-    dataset_name = image.getParent().name
-    for c, name in enumerate(image.getChannelLabels()):
-        if name in dataset_name:
+    for c, name in enumerate(image.channel_labels):
+        if name in image.dataset_name:
             filter_ch = c + 1
             break
-
-    data = [d for d in export_data if d['image_id'] == image.id]
-    if len(data) == 0:
-        return None
-    min_intensity = min([d['min'] for d in data])
-    max_intensity = max([d['max'] for d in data])
-    mean_intensity = sum([d['mean'] for d in data]) / len(data)
-    min_points = min([d['points'] for d in data])
-    max_points = max([d['points'] for d in data])
-    mean_points = sum([d['points'] for d in data]) / len(data)
-
-    return {
-        "filter_shapes_by_channel": filter_ch,
-        "shape_count": len(data),
-        "min_intensity": min_intensity,
-        "max_intensity": max_intensity,
-        "mean_intensity": mean_intensity,
-        "min_points": min_points,
-        "max_points": max_points,
-        "mean_points": mean_points,
-    }
-
-
-def group_data_by_image(conn, images, export_data, script_params):
-    """Group ROI data by Images."""
-    # Create a dict of empty lists
-    image_data = defaultdict(list)
-
-    for image in images:
-        data = get_summary_data_for_image(conn, image, export_data,
-                                          script_params)
-        for key in SUMMARY_COL_NAMES:
-            image_data[key].append(data[key] if data is not None else 0)
-
-    return image_data
+    return filter_ch
+
+
+class ImageSummary(object):
+    """
+    Running summary of the exported rows for one Image.
+
+    Blocks of rows are added as they are produced, keeping running min,
+    max and mean values so rows don't need to be stored.
+    """
+
+    def __init__(self, filter_ch):
+        """Create an empty summary."""
+        self.filter_ch = filter_ch
+        self.row_count = 0
+        # rows with stats, used for intensity and points
+        self.count = 0
+        self.min_intensity = 0
+        self.max_intensity = 0
+        self.mean_intensity = 0.0
+        self.min_points = 0
+        self.max_points = 0
+        self.mean_points = 0.0
+
+    def add(self, block):
+        """Update the summary with an ExportColumns block of rows."""
+        self.row_count += len(block)
+        points = block.get_array("points")
+        # Rows for shapes that were measured
+        measured = points != MISSING_VALUES["q"]
+        count = int(measured.sum())
+        if count == 0:
+            return
+        points = points[measured]
+        mins = block.get_array("min")[measured]
+        maxs = block.get_array("max")[measured]
+        means = block.get_array("mean")[measured]
+        if self.count == 0:
+            self.min_intensity = float(mins.min())
+            self.max_intensity = float(maxs.max())
+            self.min_points = int(points.min())
+            self.max_points = int(points.max())
+        else:
+            self.min_intensity = min(self.min_intensity, float(mins.min()))
+            self.max_intensity = max(self.max_intensity, float(maxs.max()))
+            self.min_points = min(self.min_points, int(points.min()))
+            self.max_points = max(self.max_points, int(points.max()))
+        # Combine running means with the block means, weighted by count
+        total = self.count + count
+        self.mean_intensity += ((float(means.mean()) - self.mean_intensity) *
+                                count / total)
+        self.mean_points += ((float(points.mean()) - self.mean_points) *
+                             count / total)
+        self.count = total
+
+    def get_data(self):
+        """Get the summary as a dict, or None if no rows were added."""
+        if self.row_count == 0:
+            return None
+        return {
+            "filter_shapes_by_channel": self.filter_ch,
+            "shape_count": self.row_count,
+            "min_intensity": self.min_intensity,
+            "max_intensity": self.max_intensity,
+            "mean_intensity": self.mean_intensity,
+            "min_points": self.min_points,
+            "max_points": self.max_points,
+            "mean_points": self.mean_points,
+        }
+
+
+def summarise_blocks(conn, script_params, images, image_data):
+    """
+    Yield the ExportColumns blocks for all images, summarising each image.
+
+    Each Image summary is updated as its rows are produced, then appended
+    to image_data, an ExportColumns of SUMMARY_COL_NAMES (ordered same as
+    images).
+    """
+    blocks_per_image = iter_export_data(conn, script_params, images)
+    for image, blocks in zip(images, blocks_per_image):
+        summary = ImageSummary(get_summary_filter_channel(image,
+                                                          script_params))
+        for block in blocks:
+            summary.add(block)
+            instruments.add_rows(len(block))
+            yield block
+        data = summary.get_data()
+        if data is None:
+            data = dict((key, 0) for key in SUMMARY_COL_NAMES)
+        image_data.append(data)
 
 
 def save_table(conn, images, image_data, script_params, project=None):
@@ -237,12 +1499,14 @@ def save_table(conn, images, image_data, script_params, project=None):
     resources = conn.c.sf.sharedResources()
     repository_id = resources.repositories().descriptions[0].getId().getValue()
     table_name = "batch_roi_export"
-    table = resources.newTable(repository_id, table_name)
+    table = TimedService(resources.newTable(repository_id, table_name),
+                         "Table")
 
     # Create table
     image_ids = [i.id for i in images]
     img_column = ImageColumn('Image', '', image_ids)
-    cols = [DoubleColumn(k, '', image_data[k]) for k in SUMMARY_COL_NAMES]
+    cols = [DoubleColumn(k, '', image_data.get_float_array(k).tolist())
+            for k in SUMMARY_COL_NAMES]
     data = [img_column] + cols
     table.initialize(data)
     table.addData(data)
@@ -254,19 +1518,46 @@ def save_table(conn, images, image_data, script_params, project=None):
         link_table(conn, table, project)
 
 
-def save_map_annotations(conn, images, image_data, script_params):
-    """Summarise ROIs as Key-Value pairs for each Image."""
+def save_map_annotations(conn, images, image_data, script_params,
+                         chunk_size=ANNOTATION_CHUNK_SIZE):
+    """
+    Summarise ROIs as Key-Value pairs for each Image.
+
+    Annotations and links are created locally and saved in chunks of
+    chunk_size, with one saveAndReturnArray() call per chunk.
+    Returns the number of Images that failed to save.
+    """
+    columns = [image_data.get_column(name) for name in SUMMARY_COL_NAMES]
+    links_by_group = defaultdict(list)
     for i, image in enumerate(images):
         key_value_data = []
-        for col_name in SUMMARY_COL_NAMES:
-            col_data = image_data.get(col_name)
-            key_value_data.append([col_name, str(col_data[i])])
-        map_ann = MapAnnotationWrapper(conn)
+        for col_name, col_data in zip(SUMMARY_COL_NAMES, columns):
+            key_value_data.append(NamedValue(col_name, str(col_data[i])))
+        map_ann = MapAnnotationI()
         # Use custom namespace to allow finding/deleting map_anns we create
-        map_ann.setNs(BATCH_ROI_EXPORT_NS)
-        map_ann.setValue(key_value_data)
-        map_ann.save()
-        image.linkAnnotation(map_ann)
+        map_ann.setNs(rstring(BATCH_ROI_EXPORT_NS))
+        map_ann.setMapValue(key_value_data)
+        link = ImageAnnotationLinkI()
+        link.parent = ImageI(image.id, False)
+        link.child = map_ann
+        links_by_group[image.group_id].append(link)
+
+    failed = 0
+    update_service = TimedService(conn.getUpdateService(), "UpdateService")
+    for group_id, links in links_by_group.items():
+        # Save in the group of the Images
+        ctx = conn.SERVICE_OPTS.copy()
+        ctx.setOmeroGroup(group_id)
+        for i in range(0, len(links), chunk_size):
+            chunk = links[i:i + chunk_size]
+            try:
+                update_service.saveAndReturnArray(chunk, ctx)
+            except Exception as e:
+                failed += len(chunk)
+                image_ids = [link.parent.id.val for link in chunk]
+                log("Failed to save Key-Value pairs on Images %s: %s"
+                    % (image_ids, e))
+    return failed
 
 
 def link_annotation(objects, file_ann):
@@ -276,80 +1567,119 @@ def link_annotation(objects, file_ann):
             o.linkAnnotation(file_ann)
 
 
-def batch_roi_export(conn, script_params):
-    """Main entry point. Get images, process them and return result."""
-    images = []
-    datasets = None
+def get_link_targets(conn, script_params, images):
+    """Get the objects to link exported files to: the chosen containers."""
     if script_params['Data_Type'] == "Project":
-        datasets = []
-        for project in conn.getObjects("Project", script_params['IDs']):
-            datasets.extend(list(project.listChildren()))
+        return list(conn.getObjects("Project", script_params['IDs']))
     elif script_params['Data_Type'] == "Dataset":
-        datasets = conn.getObjects("Dataset", script_params['IDs'])
+        return list(conn.getObjects("Dataset", script_params['IDs']))
+    return [i.wrapper for i in images]
+
+
+def save_timings(conn, targets, file_name="batch_roi_export_timings.json"):
+    """Save the instruments stats as a JSON file linked to targets."""
+    with open(file_name, 'w') as json_file:
+        json_file.write(instruments.to_json())
+    file_ann = conn.createFileAnnfromLocalFile(
+        file_name, mimetype="application/json")
+    link_annotation(targets, file_ann)
 
-    if datasets is not None:
-        for dataset in datasets:
-            images.extend(list(dataset.listChildren()))
-    else:
-        images = list(conn.getObjects("Image", script_params['IDs']))
+
+def batch_roi_export(conn, script_params):
+    """Main entry point. Get images, process them and return result."""
+    instruments.reset()
+    with instruments.phase("load_images"):
+        images = get_image_records(conn, script_params['Data_Type'],
+                                   script_params['IDs'])
 
     log("Processing %s images..." % len(images))
     if len(images) == 0:
         return None
 
-    # build a list of dicts.
-    export_data = []
-    for image in images:
-        export_data.extend(get_export_data(conn, script_params, image))
+    # Stream rows to csv as they are produced, summarising ROI data by
+    # Image (ordered same as images)
+    image_data = ExportColumns(SUMMARY_COL_NAMES, SUMMARY_COL_TYPES)
+    blocks = summarise_blocks(conn, script_params, images, image_data)
+
+    # Also write every row to a per-shape OMERO.table as they are produced
+    shape_table = None
+    if script_params.get("Create_Shape_Table"):
+        shape_table = ShapeTableWriter(conn, "batch_roi_export_shapes")
+        blocks = shape_table.add_blocks(blocks)
 
-    # Write to csv
     file_ann = None
-    if script_params.get("Export_CSV"):
-        file_name = script_params.get("File_Name", "")
-        file_ann = write_csv(conn, export_data, file_name, COLUMN_NAMES)
-        if script_params['Data_Type'] == "Project":
-            projects = conn.getObjects("Project", script_params['IDs'])
-            link_annotation(projects, file_ann)
-        elif script_params['Data_Type'] == "Dataset":
-            datasets = conn.getObjects("Dataset", script_params['IDs'])
-            link_annotation(datasets, file_ann)
+    link_targets = get_link_targets(conn, script_params, images)
+    with instruments.phase("export"):
+        if script_params.get("Export_CSV"):
+            file_name = script_params.get("File_Name", "")
+            export_format = script_params.get("Export_Format", CSV_FORMAT)
+            if export_format == PARQUET_FORMAT and pq is None:
+                log("pyarrow is not installed. Exporting as CSV instead")
+                export_format = CSV_FORMAT
+            if export_format == PARQUET_FORMAT:
+                file_ann = write_parquet(conn, blocks, file_name,
+                                         COLUMN_NAMES)
+            else:
+                file_ann = write_csv(conn, blocks, file_name, COLUMN_NAMES)
+            link_annotation(link_targets, file_ann)
         else:
-            link_annotation(images, file_ann)
-
-    # Group ROI data by Image (ordered same as images)
-    image_data = group_data_by_image(conn, images, export_data, script_params)
+            for block in blocks:
+                pass
 
     # Create Map_Annotations on each image
+    failed_map_anns = 0
     if script_params.get("Save_As_Key-Value"):
-        save_map_annotations(conn, images, image_data, script_params)
+        with instruments.phase("key_value"):
+            failed_map_anns = save_map_annotations(conn, images, image_data,
+                                                   script_params)
 
     # Link Table and CSV to first Project we find
     project = None
     for image in images:
-        project = image.getProject()
-        if project is not None:
+        if image.project_id is not None:
+            project = conn.getObject("Project", image.project_id)
             break
 
+    if shape_table is not None:
+        with instruments.phase("shape_table"):
+            table = shape_table.close()
+        if project is None:
+            log("No Project found to link shape table")
+        else:
+            link_table(conn, table, project)
+
     # Create single OMERO.table
     if script_params.get("Create_Table"):
-        save_table(conn, images, image_data, script_params, project)
+        with instruments.phase("summary_table"):
+            save_table(conn, images, image_data, script_params, project)
 
         image_csv_cols = ["image_id", "name", "dataset"] + SUMMARY_COL_NAMES
+        image_csv_types = {"image_id": "q", "name": STRING,
+                           "dataset": STRING}
+        image_csv_types.update(SUMMARY_COL_TYPES)
         # Save image_data as CSV on Project
-        csv_data = []
-        # convert image_data from dict of lists to a list of dicts!
+        csv_data = ExportColumns(image_csv_cols, image_csv_types)
+        summary_columns = [image_data.get_column(k)
+                           for k in SUMMARY_COL_NAMES]
         for i, image in enumerate(images):
-            row = {"image_id": str(image.getId()),
-                   "name": image.getName(),
-                   "dataset": image.getParent().getName()}
-            for k in SUMMARY_COL_NAMES:
-                row[k] = image_data.get(k)[i]
+            row = {"image_id": image.id,
+                   "name": image.name,
+                   "dataset": image.dataset_name}
+            for k, values in zip(SUMMARY_COL_NAMES, summary_columns):
+                row[k] = values[i]
             csv_data.append(row)
-        csv_ann = write_csv(conn, csv_data, "batch_roi_export.csv",
+        csv_ann = write_csv(conn, [csv_data], "batch_roi_export.csv",
                             image_csv_cols)
         project.linkAnnotation(csv_ann)
 
-    message = "Exported %s shapes" % len(export_data)
+    message = "Exported %s shapes" % image_data.get_array("shape_count").sum()
+    if failed_map_anns > 0:
+        message += ". Failed to save Key-Value pairs on %s Images" \
+            % failed_map_anns
+    message += ". " + instruments.get_message()
+    log(instruments.get_message())
+    if script_params.get("Save_Timings"):
+        save_timings(conn, link_targets)
     return file_ann, message
 
 
@@ -375,6 +1705,28 @@ def run_script():
             description="Indices of Channels to measure intensity."
             ).ofType(rint(0)),
 
+        scripts.String(
+            "Intensity_Engine", grouping="4.1", default=SERVER_ENGINE,
+            values=[rstring(SERVER_ENGINE), rstring(LOCAL_ENGINE)],
+            description=("Measure intensities on the Server, or Locally by "
+                         "reading each plane once for all shapes.")),
+
+        scripts.Int(
+            "Max_Workers", grouping="4.2", default=1, min=1,
+            description="Number of Images to process concurrently."),
+
+        scripts.Bool(
+            "Incremental_Export", grouping="4.3", default=False,
+            description=("Re-use rows from the last export for Images whose"
+                         " ROIs haven't changed. Rows are cached as a file"
+                         " on each Image.")),
+
+        scripts.List(
+            "Shape_Types", grouping="4.4",
+            description=("Only export these types of shape, e.g. Rectangle,"
+                         " Polygon. Export all types if empty.")
+            ).ofType(rstring("")),
+
         scripts.Bool(
             "Export_All_Planes", grouping="5",
             description=("Export all Z and T planes for shapes "
@@ -383,12 +1735,18 @@ def run_script():
 
         scripts.Bool(
             "Export_CSV",  grouping="6", default=True,
-            description="Create a comma-separated-values file to download."),
+            description="Create a CSV or Parquet file to download."),
 
         scripts.String(
             "File_Name", grouping="6.1", default=DEFAULT_FILE_NAME,
             description="Name of the exported CSV file."),
 
+        scripts.String(
+            "Export_Format", grouping="6.2", default=CSV_FORMAT,
+            values=[rstring(CSV_FORMAT), rstring(PARQUET_FORMAT)],
+            description=("Export as CSV, or as a typed Parquet file"
+                         " (needs pyarrow installed on the server).")),
+
         scripts.Bool(
             "Save_As_Key-Value",  grouping="7", default=True,
             description="Summarise ROIs as Key-Value pairs on each Image."),
@@ -398,6 +1756,16 @@ def run_script():
             description=("Summarise ROIs as Table (1 row per image)"
                          " attached to parent Project")),
 
+        scripts.Bool(
+            "Create_Shape_Table", grouping="8.1", default=False,
+            description=("Export every row as a Table (1 row per shape per"
+                         " plane and channel) attached to parent Project")),
+
+        scripts.Bool(
+            "Save_Timings", grouping="9", default=False,
+            description=("Save the time of each step and of remote calls as"
+                         " a JSON file, attached like the CSV.")),
+
         authors=["William Moore", "OME Team"],
         institutions=["University of Dundee"],
         contact="ome-users@lists.openmicroscopy.org.uk",